@@ -1,8 +1,25 @@
 from flask import Flask, request, jsonify
 from flask_cors import CORS
 import boto3
+from boto3.dynamodb.conditions import Attr, Key
+import base64
+import gzip
+import hashlib
 import json
+import os
+import sys
+import time
+import uuid
+from collections import OrderedDict
 from datetime import datetime
+from decimal import Decimal
+
+# the receipt Lambda's modules (flat imports, as in the Lambda bundle)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "receipt_lambda"))
+from budget_assistant import BudgetAssistant, load_user_index
+from categorizer import save_correction
+from multi_receipt import to_amount, vendor_key
+from claude_wrapper import ClaudeWrapper
 
 
 # Initialize AWS clients
@@ -43,23 +60,26 @@ example_state = {
 
 def save_state(bucket_name: str, table_name: str, user_id: str, string_encoding: str, current_state: dict):
     """
-    1. Uploads string_encoding as a TXT file to S3
+    1. Uploads string_encoding (if any) as a TXT file to S3
     2. Writes current_state as a dictionary to DynamoDB
     """
 
     # ---- S3 upload ----
     timestamp = datetime.utcnow().strftime("%Y%m%dT%H%M%SZ")
-    key = f"receipts/uploads/state_{timestamp}.txt"
-
-    # Upload string_encoding to S3
-    s3.put_object(
-        Bucket=bucket_name,
-        Key=key,
-        Body=string_encoding,
-        ContentType="text/plain"
-    )
-    s3_uri = f"s3://{bucket_name}/{key}"
-    print(f"✅ Uploaded string encoding to {s3_uri}")
+    s3_uri = None
+    if string_encoding:
+        # not under receipts/uploads/: the receipt Lambda would read it as a receipt
+        key = f"states/{user_id}/state_{timestamp}.txt"
+
+        # Upload string_encoding to S3
+        s3.put_object(
+            Bucket=bucket_name,
+            Key=key,
+            Body=string_encoding,
+            ContentType="text/plain"
+        )
+        s3_uri = f"s3://{bucket_name}/{key}"
+        print(f"✅ Uploaded string encoding to {s3_uri}")
 
     # ---- DynamoDB write ----
     table = dynamodb.Table(table_name)
@@ -78,7 +98,8 @@ def save_state(bucket_name: str, table_name: str, user_id: str, string_encoding:
         "timestamp": timestamp
     }
 
-    table.put_item(Item=item)
+    # DynamoDB rejects floats; store numbers as Decimal
+    table.put_item(Item=json.loads(json.dumps(item), parse_float=Decimal))
     print(f"✅ Saved state to DynamoDB for user {user_id}")
 
     return {"s3_uri": s3_uri, "ddb_item": item}
@@ -90,6 +111,19 @@ CORS(app)
 
 BUCKET_NAME = "hackcmu-2025"  # Replace with your S3 bucket name
 TABLE_NAME = "receipts"    # Replace with your DynamoDB table name
+STATE_TABLE_NAME = "budget-states"  # dashboard state snapshots (partition key user_id, sort key stateId)
+# shared category index; the receipt Lambda's CATEGORY_INDEX_S3 must point at the same prefix
+CATEGORY_INDEX_S3 = os.environ.get("CATEGORY_INDEX_S3", f"s3://{BUCKET_NAME}/category-index/")
+
+PAGE_SIZE = 25             # transactions per page by default (one dashboard screen)
+MAX_PAGE_SIZE = 100
+MAX_QUERY_ROUNDS = 10      # DynamoDB queries per request when filters skip most rows
+MIN_GZIP_BYTES = 1024      # smaller responses aren't worth compressing
+MAX_CONVERSATIONS = 200    # budget assistant conversations kept in memory, least recently used dropped
+INDEX_MAX_AGE = 600        # seconds an assistant's index is only topped up; then it is reloaded whole,
+                           # which picks up receipts stored under an earlier date and recategorized rows
+
+assistants = OrderedDict()  # user_id -> BudgetAssistant
 
 
 # @app.route('/api/update-state', methods = ['POST'])
@@ -121,32 +155,20 @@ TABLE_NAME = "receipts"    # Replace with your DynamoDB table name
 
 #     return jsonify(current_state)
 
+@app.route('/api/update-state', methods = ['POST'])
 def update_state():
     data = request.get_json()
     current_state = data.get("state", {})
     user_id = data.get("user_id", "default_user")  # Get user_id from request
     string_encoding = data.get("string_encoding", "")  # Get string_encoding from request
 
-    # Add sample transaction
-    sample_transaction = {
-        "name": "Costco",
-        "amount": 20.5,
-        "date": "2025-09-14",
-        "category": "Food & Dining",
-    }
-    
-    # Ensure transactions list exists
-    if "transactions" not in current_state:
-        current_state["transactions"] = []
-    
-    current_state["transactions"].append(sample_transaction)
     current_state["receipt"] = ""
 
     # Save to S3 and DynamoDB
     try:
         result = save_state(
             bucket_name=BUCKET_NAME,
-            table_name=TABLE_NAME,
+            table_name=STATE_TABLE_NAME,
             user_id=user_id,
             string_encoding=string_encoding,
             current_state=current_state
@@ -174,5 +196,186 @@ def update_state():
         }), 500
 
 
+def encode_cursor(last_key: dict) -> str:
+    """Opaque page cursor from DynamoDB's LastEvaluatedKey"""
+    return base64.urlsafe_b64encode(json.dumps(last_key, default=str).encode("utf-8")).decode("ascii")
+
+def decode_cursor(cursor: str, user_id: str) -> dict:
+    """ExclusiveStartKey for a cursor; ValueError if it is malformed or for another user"""
+    try:
+        last_key = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except Exception:
+        raise ValueError("invalid cursor")
+    if not isinstance(last_key, dict) or last_key.get("userId") != user_id or "date" not in last_key:
+        raise ValueError("invalid cursor")
+    return {"userId": user_id, "date": str(last_key["date"])}
+
+def to_transaction(row: dict) -> dict:
+    """Receipt row (as written by the receipt Lambda) in the dashboard's transaction shape"""
+    # amounts are as the model reported them; the receipt row carries a warning if unreadable
+    amount = to_amount(row.get("total"))
+    if amount is None:
+        amount = to_amount(row.get("subtotal"))
+    return {
+        "id": row["date"],                  # sort key, unique per user
+        "name": row.get("vendor") or "Receipt",
+        "amount": amount or 0.0,
+        "date": row["date"][:10],           # multi-receipt scans store "<date>#<n>"
+        "category": row.get("category"),
+    }
+
+def query_transactions(table, user_id: str, start=None, end=None, category=None, vendor=None,
+                       limit: int = PAGE_SIZE, cursor=None, newest_first: bool = True):
+    """
+    One page of a user's parsed receipts, read straight off the date sort key.
+
+    Returns:
+        (transactions, next_cursor); next_cursor is None on the last page
+    """
+    key = Key("userId").eq(user_id)
+    # "~" sorts after the "#<n>" suffix, so the end day is included whole
+    if start and end:
+        key = key & Key("date").between(start, end + "~")
+    elif start:
+        key = key & Key("date").gte(start)
+    elif end:
+        key = key & Key("date").lt(end + "~")
+
+    condition = Attr("status").eq("parsed")
+    if category:
+        condition = condition & Attr("category").eq(category)
+    if vendor_key(vendor):
+        # case-insensitive on vendorKey; rows stored before it existed only match the exact case
+        condition = condition & (Attr("vendorKey").contains(vendor_key(vendor)) | Attr("vendor").contains(vendor))
+
+    kwargs = {
+        "KeyConditionExpression": key,
+        "FilterExpression": condition,
+        "ScanIndexForward": not newest_first,
+        # only what the list shows, not every line item
+        "ProjectionExpression": "userId, #d, vendor, #t, subtotal, category",
+        "ExpressionAttributeNames": {"#d": "date", "#t": "total"},
+    }
+    if cursor:
+        kwargs["ExclusiveStartKey"] = cursor
+
+    # Limit counts rows read before the filter, so keep reading until the page is full
+    rows, last_key = [], None
+    for _ in range(MAX_QUERY_ROUNDS):
+        resp = table.query(Limit=limit - len(rows), **kwargs)
+        rows.extend(resp.get("Items", []))
+        last_key = resp.get("LastEvaluatedKey")
+        if not last_key or len(rows) >= limit:
+            break
+        kwargs["ExclusiveStartKey"] = last_key
+
+    return [to_transaction(r) for r in rows], encode_cursor(last_key) if last_key else None
+
+def cached_json(payload: dict):
+    """JSON response with a weak ETag (304 on If-None-Match) and gzip when the client accepts it"""
+    body = json.dumps(payload, separators=(",", ":")).encode("utf-8")
+    response = app.response_class(body, mimetype="application/json")
+    response.set_etag(hashlib.sha256(body).hexdigest()[:32], weak=True)
+    response.headers["Cache-Control"] = "private, no-cache"
+    response.vary.add("Accept-Encoding")
+
+    response.make_conditional(request)
+    if response.status_code == 304:
+        return response
+
+    if len(body) >= MIN_GZIP_BYTES and "gzip" in request.headers.get("Accept-Encoding", ""):
+        response.set_data(gzip.compress(body, compresslevel=6))
+        response.headers["Content-Encoding"] = "gzip"
+    return response
+
+@app.route('/api/transactions', methods = ['GET'])
+def get_transactions():
+    """
+    GET /api/transactions?user_id=&from=YYYY-MM-DD&to=YYYY-MM-DD&category=&vendor=&limit=&cursor=&order=desc|asc
+    The first call (no cursor) is the dashboard's first screen; pass next_cursor back for the following page.
+    vendor matches any part of the vendor name, ignoring case. category matches a receipt's own category,
+    the one most of its money went to, so a receipt with a few items in another category isn't listed for it.
+    """
+    args = request.args
+    user_id = args.get("user_id")
+    if not user_id:
+        return jsonify({"error": "user_id is required"}), 400
+
+    try:
+        limit = min(max(int(args.get("limit", PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+        for day in (args.get("from"), args.get("to")):
+            if day:
+                datetime.strptime(day, "%Y-%m-%d")
+        cursor = decode_cursor(args["cursor"], user_id) if args.get("cursor") else None
+    except ValueError as e:
+        return jsonify({"error": f"bad request: {e}"}), 400
+
+    try:
+        transactions, next_cursor = query_transactions(
+            dynamodb.Table(TABLE_NAME), user_id,
+            start=args.get("from"), end=args.get("to"),
+            category=args.get("category"), vendor=args.get("vendor"),
+            limit=limit, cursor=cursor, newest_first=args.get("order", "desc") != "asc")
+    except Exception as e:
+        print(f"❌ Error reading transactions: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+    return cached_json({"transactions": transactions, "next_cursor": next_cursor, "count": len(transactions)})
+
+
+def assistant_for(user_id: str, new_conversation: bool = False) -> BudgetAssistant:
+    """The user's ongoing conversation, with its index brought up to date with their latest receipts"""
+    table = dynamodb.Table(TABLE_NAME)
+    assistant = None if new_conversation else assistants.pop(user_id, None)
+    if assistant is None:
+        assistant = BudgetAssistant(ClaudeWrapper(), load_user_index(table, user_id))
+    elif time.time() - assistant.index.loaded_at > INDEX_MAX_AGE:
+        assistant.index = load_user_index(table, user_id)
+    else:
+        load_user_index(table, user_id, assistant.index)
+
+    assistants[user_id] = assistant
+    while len(assistants) > MAX_CONVERSATIONS:
+        assistants.popitem(last=False)
+    return assistant
+
+@app.route('/api/ask', methods = ['POST'])
+def ask():
+    """
+    POST /api/ask {"user_id", "question", "new_conversation": false}
+    Answers a spending question; later questions from the same user are follow-ups unless new_conversation is set.
+    """
+    data = request.get_json(silent=True) or {}
+    user_id, question = data.get("user_id"), (data.get("question") or "").strip()
+    if not user_id or not question:
+        return jsonify({"error": "user_id and question are required"}), 400
+
+    try:
+        answer = assistant_for(user_id, bool(data.get("new_conversation"))).ask(question)
+    except Exception as e:
+        print(f"❌ Error answering question: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+    return jsonify({"answer": answer})
+
+
+@app.route('/api/categories/correct', methods = ['POST'])
+def correct_category():
+    """
+    POST /api/categories/correct {"name", "category", "vendor"}
+    Records the user's category for an item name; the receipt Lambda applies it from its next invocation.
+    """
+    data = request.get_json(silent=True) or {}
+    try:
+        key = save_correction(s3, CATEGORY_INDEX_S3, data.get("name") or "", data.get("category") or "", data.get("vendor"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        print(f"❌ Error saving category correction: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+    return jsonify({"name": key, "category": data["category"]})
+
+
 if __name__ == "__main__":
     app.run(debug=True, port=5050, host="0.0.0.0")
\ No newline at end of file
@@ -5,15 +5,31 @@ from urllib.parse import unquote_plus
 from decimal import Decimal
 
 from claude_wrapper import ClaudeWrapper  # your wrapper
+from receipt_prefilter import ReceiptPrefilter
+from categorizer import CategoryIndex, Categorizer, load_corrections, load_index, save_index
+from multi_receipt import check_totals, extract_pages, extract_regions, to_amount, vendor_key
 
 TABLE_NAME  = os.environ["RECEIPTS_TABLE"]
 MAX_TOKENS  = int(os.environ.get("ANTHROPIC_MAX_TOKENS", "1000"))
+PREFILTER   = os.environ.get("PREFILTER_ENABLED", "1") == "1"
+CATEGORIES  = [c.strip() for c in os.environ.get("RECEIPT_CATEGORIES", "").split(",") if c.strip()]
+CATEGORY_INDEX_PATH = os.environ.get("CATEGORY_INDEX_PATH", "category_index.json")  # bundled seed index
+CATEGORY_INDEX_S3   = os.environ.get("CATEGORY_INDEX_S3", "")  # s3://bucket/prefix shared with the API; unset = not persisted
+SPLIT_REGIONS = os.environ.get("SPLIT_REGIONS", "1") == "1"
 
 s3  = boto3.client("s3")
 ddb = boto3.resource("dynamodb").Table(TABLE_NAME)
 
 DATA_URL_RE = re.compile(r"^data:(?P<mime>[^;]+);base64,(?P<b64>.+)$", re.I)
 
+# module level so duplicate detection survives across warm invocations
+prefilter = ReceiptPrefilter()
+# learned name -> category index; loaded once per container, saved after invocations that taught it something
+if CATEGORY_INDEX_S3:
+    category_index = load_index(s3, CATEGORY_INDEX_S3, seed_path=CATEGORY_INDEX_PATH)
+else:
+    category_index = CategoryIndex.load(CATEGORY_INDEX_PATH)
+
 def decimalize(x):
     if isinstance(x, float): return Decimal(str(x))
     if isinstance(x, dict):  return {k: decimalize(v) for k, v in x.items()}
@@ -24,69 +40,187 @@ def extract_b64(text: str) -> str:
     m = DATA_URL_RE.match(text.strip())
     return m.group("b64") if m else text.strip()
 
+def read_b64(bucket: str, key: str) -> str:
+    # read base64 string from S3 (no decoding)
+    body_text = s3.get_object(Bucket=bucket, Key=key)["Body"].read().decode("utf-8")
+    return extract_b64(body_text)
+
+def parse_images(body_text: str) -> list:
+    # one data URL, or a JSON array of them for the pages of one long receipt
+    body_text = body_text.strip()
+    if body_text.startswith("["):
+        return [extract_b64(page) for page in json.loads(body_text)]
+    return [extract_b64(body_text)]
+
+def read_images(bucket: str, key: str) -> list:
+    return parse_images(s3.get_object(Bucket=bucket, Key=key)["Body"].read().decode("utf-8"))
+
+def derive_user(key: str) -> str:
+    # receipts/uploads/<userId>/...
+    parts = key.split("/")
+    return parts[2] if len(parts) >= 3 else "unknown"
+
+def store_rejected(key: str, reason: str, table=None):
+    """
+    Write the row for an image the pre-filter kept away from Claude.
+    The sort key ("<date>#rej-<key>") is unique per upload so it can't
+    overwrite a parsed receipt from the same day, or another reject.
+    """
+    if table is None:
+        table = ddb
+
+    today = time.strftime("%Y-%m-%d", time.gmtime())
+    table.put_item(Item={
+        "userId": derive_user(key),
+        "date": f"{today}#rej-{key}",
+        "status": "duplicate" if reason == "duplicate" else "unrecognized",
+        "rejectedBy": "prefilter",
+        "reason": reason,
+        "s3Key": key,
+        "parsedAt": int(time.time())
+    })
+
+def top_category(items: list):
+    # the receipt's category for list filtering: where most of the money went
+    # (unreadable costs count as 0; check_totals records a warning for them)
+    spend = {}
+    for item in items:
+        if item.get("category"):
+            spend[item["category"]] = spend.get(item["category"], 0) + (to_amount(item.get("cost")) or 0)
+    return max(spend, key=spend.get) if spend else None
+
+def make_categorizer(claude, categories: list = None, defer: bool = False):
+    # categories default to RECEIPT_CATEGORIES; none configured means the vision call categorizes
+    return Categorizer(claude, category_index, defer=defer) if (CATEGORIES if categories is None else categories) else None
+
+def refresh_category_index():
+    """Pick up corrections users made through the API since the container started"""
+    if CATEGORY_INDEX_S3:
+        category_index.apply_corrections(load_corrections(s3, CATEGORY_INDEX_S3))
+
+def save_category_index():
+    """Write the index back if it learned anything, so the next cold start doesn't begin empty"""
+    if CATEGORY_INDEX_S3 and category_index.unsaved:
+        save_index(s3, CATEGORY_INDEX_S3, category_index)
+
+def store_result(key: str, result_str, table=None, categorizer=None, part=None, categories: list = None):
+    """
+    Parse Claude's output for the receipt at `key` and write its row.
+    `part` numbers the receipts found in one image; it is appended to the
+    sort key ("<date>#<part>") so they don't overwrite each other.
+    `categories` are what the categorizer may assign (default RECEIPT_CATEGORIES).
+
+    Returns:
+        The row as written
+    """
+    if table is None:
+        table = ddb
+
+    # derive keys (fallbacks if not in JSON)
+    derived_user = derive_user(key)
+    suffix = f"#{part}" if part is not None else ""
+    today = time.strftime("%Y-%m-%d", time.gmtime())
+
+    if not result_str or result_str.strip().lower() == "none":
+        # minimal "not a receipt" row
+        row = {
+            "userId": derived_user,
+            "date": today + suffix,
+            "status": "unrecognized",
+            "s3Key": key,
+            "parsedAt": int(time.time())
+        }
+        table.put_item(Item=row)
+        return row
+
+    # parse JSON (if it fails, just store raw)
+    try:
+        parsed = json.loads(result_str)
+    except json.JSONDecodeError:
+        row = {
+            "userId": derived_user,
+            "date": today + suffix,
+            "status": "parsed_raw",
+            "s3Key": key,
+            "claudeRaw": result_str,
+            "parsedAt": int(time.time())
+        }
+        table.put_item(Item=row)
+        return row
+
+    # item categories come from the local index, ambiguous ones in one text-only call
+    if categorizer is not None:
+        categorizer.categorize(parsed.get("items", []), CATEGORIES if categories is None else categories,
+                               vendor=parsed.get("vendor"))
+    else:
+        # the vision call categorized them; learn that for when local categorization is on
+        category_index.learn_receipt(parsed)
+
+    user_id = str(parsed.get("userId") or derived_user)
+    date_iso = str(parsed.get("date") or today) + suffix
+
+    item = {
+        "userId":   user_id,                 # PK
+        "date":     date_iso,                # SK
+        "status":   "parsed",
+        "vendor":   parsed.get("vendor"),
+        "vendorKey": vendor_key(parsed.get("vendor")),   # what /api/transactions?vendor= searches
+        "items":    parsed.get("items", []),
+        "category": top_category(parsed.get("items", [])),
+        "subtotal": parsed.get("subtotal"),
+        "taxes":    parsed.get("taxes"),
+        "fees":     parsed.get("fees"),
+        "total":    parsed.get("total"),
+        "warnings": check_totals(parsed) or None,
+        "part":     part,
+        "s3Key":    key,
+        "parsedAt": int(time.time())
+    }
+
+    # drop None and write
+    item = decimalize({k: v for k, v in item.items() if v is not None})
+    table.put_item(Item=item)
+    return item
+
 def handler(event, context):
     claude = ClaudeWrapper()  # uses ANTHROPIC_API_KEY_1
+    refresh_category_index()
+    categorizer = make_categorizer(claude)
+    # with a categorizer the vision call only reads the receipt; items are categorized afterwards
+    categories = None if categorizer else []
 
     for rec in event.get("Records", []):
         bucket = rec["s3"]["bucket"]["name"]
         key    = unquote_plus(rec["s3"]["object"]["key"])
 
-        # read base64 string from S3 (no decoding)
-        body_text = s3.get_object(Bucket=bucket, Key=key)["Body"].read().decode("utf-8")
-        b64_str   = extract_b64(body_text)
-
-        # call Claude (expects JSON string or "None")
-        result_str = claude.read_receipt(base64_input=b64_str, max_tokens=MAX_TOKENS)
-
-        # derive keys (fallbacks if not in JSON)
-        parts = key.split("/")
-        derived_user = parts[2] if len(parts) >= 3 else "unknown"
-        today = time.strftime("%Y-%m-%d", time.gmtime())
-
-        if not result_str or result_str.strip().lower() == "none":
-            # minimal "not a receipt" row
-            ddb.put_item(Item={
-                "userId": derived_user,
-                "date": today,
-                "status": "unrecognized",
-                "s3Key": key,
-                "parsedAt": int(time.time())
-            })
-            continue
-
-        # parse JSON (if it fails, just store raw)
-        try:
-            parsed = json.loads(result_str)
-        except json.JSONDecodeError:
-            ddb.put_item(Item={
-                "userId": derived_user,
-                "date": today,
-                "status": "parsed_raw",
-                "s3Key": key,
-                "claudeRaw": result_str,
-                "parsedAt": int(time.time())
-            })
-            continue
-
-        user_id = str(parsed.get("userId") or derived_user)
-        date_iso = str(parsed.get("date") or today)
-
-        item = {
-            "userId":   user_id,                 # PK
-            "date":     date_iso,                # SK
-            "status":   "parsed",
-            "vendor":   parsed.get("vendor"),
-            "items":    parsed.get("items", []),
-            "subtotal": parsed.get("subtotal"),
-            "taxes":    parsed.get("taxes"),
-            "fees":     parsed.get("fees"),
-            "total":    parsed.get("total"),
-            "s3Key":    key,
-            "parsedAt": int(time.time())
-        }
-
-        # drop None and write
-        item = {k: v for k, v in item.items() if v is not None}
-        ddb.put_item(Item=decimalize(item))
-
+        images = read_images(bucket, key)
+        verdict = None
+
+        if len(images) > 1:
+            # pages of one long receipt, read in parallel and merged
+            results = [extract_pages(claude, images, categories, max_tokens=MAX_TOKENS)]
+        else:
+            # skip the vision call for obvious non-receipts and repeat uploads
+            thumbnail = None
+            if PREFILTER:
+                verdict = prefilter.check(images[0], user=derive_user(key), key=key)
+                if not verdict:
+                    store_rejected(key, verdict.reason)
+                    continue
+                thumbnail = verdict.features.get("thumbnail")
+
+            # call Claude (expects JSON string or "None"), once per receipt in the image
+            if SPLIT_REGIONS:
+                results = extract_regions(claude, images[0], categories, max_tokens=MAX_TOKENS, thumbnail=thumbnail)
+            else:
+                results = [claude.read_receipt(base64_input=images[0], categories=categories, max_tokens=MAX_TOKENS)]
+
+        for part, result_str in enumerate(results):
+            store_result(key, result_str, categorizer=categorizer, part=part if len(results) > 1 else None)
+
+        # only a stored upload can make later ones duplicates; a failed attempt is retried as new
+        if verdict is not None:
+            prefilter.remember(derive_user(key), verdict.features, key)
+
+    save_category_index()
     return {"ok": True}
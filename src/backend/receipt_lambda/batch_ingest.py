@@ -0,0 +1,397 @@
+# batch_ingest.py  (python batch_ingest.py --s3-prefix s3://bucket/receipts/uploads/)
+#                  (python batch_ingest.py --manifest photos.txt --user-id <userId>)
+"""
+Bulk/backfill receipt ingestion through the Message Batches API.
+
+Reads receipts from a manifest file or an S3 prefix, submits them in chunks
+as message batches, polls with backoff, and streams the results through the
+same parse-and-store path the Lambda uses (app.store_result). Progress is kept
+in a checkpoint file so an interrupted run can be resumed.
+
+With categories configured, items the local index can't place are not sent
+to Claude one receipt at a time: their rows are stored with a fallback
+category and, once every receipt is in, all of them are categorized in one
+follow-up message batch and the rows rewritten.
+
+Objects holding a JSON array of data URLs (the pages of one long receipt)
+are submitted one request per page and merged before they are stored.
+"""
+import os, json, time, hashlib, argparse, base64
+from collections import Counter
+from typing import Dict, List, Optional
+
+import app
+from claude_wrapper import ClaudeWrapper
+from multi_receipt import merge_results
+from receipt_prefilter import ReceiptPrefilter
+
+CHUNK_SIZE       = int(os.environ.get("BATCH_CHUNK_SIZE", "500"))
+CHUNK_BYTES      = 200 * 1024 * 1024   # stay under the 256 MB request body limit
+POLL_INTERVAL    = 5.0
+MAX_POLL_INTERVAL = 60.0
+SAVE_EVERY       = 50                  # results between checkpoint writes
+
+IMAGE_EXTS = {"jpg", "jpeg", "png", "gif", "webp"}
+
+
+def split_s3_uri(uri: str) -> tuple[str, str]:
+    bucket, _, key = uri[len("s3://"):].partition("/")
+    return bucket, key
+
+def list_sources(manifest: Optional[str] = None, s3_prefix: Optional[str] = None) -> List[str]:
+    """
+    Collect receipt sources to ingest.
+
+    Args:
+        manifest: Path to a file with one source per line (s3://bucket/key or local path)
+        s3_prefix: s3://bucket/prefix to list
+
+    Returns:
+        List of sources in a stable order
+    """
+    if manifest:
+        with open(manifest, "r", encoding="utf-8") as f:
+            return [line.strip() for line in f if line.strip() and not line.startswith("#")]
+
+    bucket, prefix = split_s3_uri(s3_prefix)
+    sources = []
+    for page in app.s3.get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            if not obj["Key"].endswith("/"):
+                sources.append(f"s3://{bucket}/{obj['Key']}")
+    return sources
+
+def source_key(source: str, user_id: Optional[str] = None) -> str:
+    """
+    Key recorded as s3Key (and used to derive the user) for a source.
+
+    S3 sources keep their key. Local files are filed under
+    receipts/uploads/<user_id>/, or must already follow that layout.
+
+    Raises:
+        ValueError: for a local path with no user_id outside that layout
+    """
+    if source.startswith("s3://"):
+        return split_s3_uri(source)[1]
+
+    path = source.replace(os.sep, "/")
+    if user_id:
+        return f"receipts/uploads/{user_id}/{path.rsplit('/', 1)[-1]}"
+    marker = path.find("receipts/uploads/")
+    if marker >= 0 and len(path[marker:].split("/")) >= 4:
+        return path[marker:]
+    raise ValueError(f"{source}: local files need --user-id or a receipts/uploads/<userId>/ path")
+
+def load_images(source: str) -> List[str]:
+    """Read a source as a list of base64 pages, the same way the Lambda does for S3."""
+    if source.startswith("s3://"):
+        return app.read_images(*split_s3_uri(source))
+
+    with open(source, "rb") as f:
+        data = f.read()
+    if source.lower().rsplit(".", 1)[-1] in IMAGE_EXTS:
+        return [base64.b64encode(data).decode("utf-8")]
+    return app.parse_images(data.decode("utf-8"))
+
+def pending_names(row: Dict) -> List[str]:
+    """Distinct names of a stored row's items still waiting for a category"""
+    return list(dict.fromkeys(i.get("name", "") for i in row.get("items", []) if i.get("categoryPending")))
+
+def custom_id_for(source: str, page: Optional[int] = None) -> str:
+    # deterministic, so the same receipt (or page of it) maps to the same id across runs
+    name = source if page is None else f"{source}#page{page}"
+    return hashlib.sha1(name.encode("utf-8")).hexdigest()[:32]
+
+def page_ids(source: str, pages: int) -> List[str]:
+    """A submitted source's custom ids in page order (one id for a single image)"""
+    return [custom_id_for(source)] if pages == 1 else [custom_id_for(source, n) for n in range(pages)]
+
+
+class Checkpoint:
+    """
+    Resumable progress for a backfill run.
+
+    File layout:
+        {"done": [source, ...], "batches": {batch_id: {custom_id: source}},  # one custom_id per page
+         "pending": [[userId, date], ...], "categoryBatch": batch_id or null}
+
+    "pending" are rows with items waiting for the follow-up categorization batch.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.done = set()
+        self.batches: Dict[str, Dict[str, str]] = {}
+        self.pending: List[List[str]] = []
+        self.category_batch: Optional[str] = None
+
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            self.done = set(data.get("done", []))
+            self.batches = data.get("batches", {})
+            self.pending = data.get("pending", [])
+            self.category_batch = data.get("categoryBatch")
+
+    def in_flight(self) -> set:
+        return {src for mapping in self.batches.values() for src in mapping.values()}
+
+    def save(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"done": sorted(self.done), "batches": self.batches,
+                       "pending": self.pending, "categoryBatch": self.category_batch}, f)
+        os.replace(tmp, self.path)
+
+
+class BatchIngestor:
+    """Submits receipts as message batches and stores their results."""
+
+    def __init__(self,
+                 claude: ClaudeWrapper,
+                 checkpoint: Checkpoint,
+                 table=None,
+                 user_id: Optional[str] = None,
+                 categories: Optional[list] = None,
+                 max_tokens: int = app.MAX_TOKENS,
+                 chunk_size: int = CHUNK_SIZE,
+                 chunk_bytes: int = CHUNK_BYTES,
+                 poll_interval: float = POLL_INTERVAL,
+                 max_poll_interval: float = MAX_POLL_INTERVAL,
+                 sleep=time.sleep):
+        self.claude = claude
+        self.checkpoint = checkpoint
+        self.table = table
+        self.user_id = user_id
+        self.categories = app.CATEGORIES if categories is None else categories   # default RECEIPT_CATEGORIES
+        self.max_tokens = max_tokens
+        self.chunk_size = chunk_size
+        self.chunk_bytes = chunk_bytes
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.sleep = sleep
+        # a backfill submits many receipts within seconds, so near matches (often the same store's
+        # receipts) would all fall inside the duplicate window; only repeated files are skipped
+        self.prefilter = ReceiptPrefilter(duplicate_window=0) if app.PREFILTER else None
+        # ambiguous item names wait for one follow-up batch instead of a call per receipt
+        self.categorizer = app.make_categorizer(claude, self.categories, defer=True)
+        self.stats = {"submitted": 0, "stored": 0, "failed": 0, "skipped": 0, "rejected": 0, "categorized": 0}
+
+    def run(self, sources: List[str]) -> Dict[str, int]:
+        """
+        Ingest every source not already done.
+
+        Batches left in flight by a previous run are collected first, then the
+        remaining sources are submitted chunk by chunk and collected in order.
+        Items left pending are categorized last, in one batch.
+        """
+        app.refresh_category_index()
+        if self.checkpoint.category_batch:
+            self.categorize_pending()
+        for batch_id in list(self.checkpoint.batches):
+            self.collect(batch_id)
+
+        in_flight = self.checkpoint.in_flight()
+        todo = [s for s in dict.fromkeys(sources) if s not in self.checkpoint.done and s not in in_flight]
+        for source in todo:
+            self.key(source)  # fail before anything is submitted, not halfway through
+        self.stats["skipped"] += len(sources) - len(todo)
+
+        batch_ids = [self.submit(chunk) for chunk in self.chunks(todo)]
+        for batch_id in batch_ids:
+            self.collect(batch_id)
+        self.categorize_pending()
+
+        self.checkpoint.save()
+        app.save_category_index()
+        return self.stats
+
+    def key(self, source: str) -> str:
+        return source_key(source, self.user_id)
+
+    def chunks(self, sources: List[str]):
+        """Yield lists of (source, [base64 page, ...]) bounded by request count and bytes."""
+        chunk, requests, size = [], 0, 0
+        for source in sources:
+            pages = load_images(source)
+            if self.prefilter and len(pages) == 1:
+                # like the Lambda, only single images are pre-filtered
+                user = app.derive_user(self.key(source))
+                verdict = self.prefilter.check(pages[0], user=user, key=self.key(source))
+                if not verdict:
+                    app.store_rejected(self.key(source), verdict.reason, table=self.table)
+                    self.checkpoint.done.add(source)
+                    self.stats["rejected"] += 1
+                    continue
+                # results only arrive after the whole chunk is submitted, so repeats within a
+                # run are caught at submit time; the key keeps a resubmitted source from matching itself
+                self.prefilter.remember(user, verdict.features, self.key(source))
+            pages_size = sum(len(page) for page in pages)
+            if chunk and (requests + len(pages) > self.chunk_size or size + pages_size > self.chunk_bytes):
+                yield chunk
+                chunk, requests, size = [], 0, 0
+            chunk.append((source, pages))
+            requests += len(pages)
+            size += pages_size
+        if chunk:
+            yield chunk
+
+    def submit(self, chunk) -> str:
+        requests = []
+        mapping = {}
+        # with a categorizer the vision call only reads the receipt; items are categorized when stored
+        categories = None if self.categorizer else self.categories
+        for source, pages in chunk:
+            for page, b64_str in enumerate(pages):
+                custom_id = custom_id_for(source, page if len(pages) > 1 else None)
+                mapping[custom_id] = source
+                requests.append(self.claude.receipt_batch_request(
+                    custom_id, b64_str, categories=categories, max_tokens=self.max_tokens))
+
+        batch = self.claude.client.messages.batches.create(requests=requests)
+        self.checkpoint.batches[batch.id] = mapping
+        self.checkpoint.save()
+        self.stats["submitted"] += len(chunk)
+        print(f"Submitted batch {batch.id} ({len(chunk)} receipts, {len(requests)} requests)")
+        return batch.id
+
+    def wait(self, batch_id: str):
+        """Poll a batch with exponential backoff until it has ended."""
+        interval = self.poll_interval
+        while True:
+            batch = self.claude.client.messages.batches.retrieve(batch_id)
+            if batch.processing_status == "ended":
+                return batch
+            self.sleep(interval)
+            interval = min(interval * 2, self.max_poll_interval)
+
+    def collect(self, batch_id: str):
+        """Stream a finished batch's results into the table."""
+        mapping = self.checkpoint.batches[batch_id]
+        self.wait(batch_id)
+
+        pending = 0
+        page_counts = Counter(mapping.values())
+        failed = set()
+        pages: Dict[str, Dict[str, str]] = {}   # multi-page source -> {custom_id: text} so far
+        for entry in self.claude.client.messages.batches.results(batch_id):
+            source = mapping.get(entry.custom_id)
+            if source is None or source in self.checkpoint.done or source in failed:
+                continue
+
+            if entry.result.type != "succeeded":
+                # left out of "done" so the next run resubmits it, every page if it has several
+                failed.add(source)
+                self.stats["failed"] += 1
+                print(f"❌ {source}: {entry.result.type}")
+                continue
+
+            ids = page_ids(source, page_counts[source])
+            if len(ids) == 1:
+                self.store(source, entry.result.message.content[0].text)
+            else:
+                got = pages.setdefault(source, {})
+                got[entry.custom_id] = entry.result.message.content[0].text
+                if len(got) < len(ids):
+                    continue
+                # every page is in: merge them into one receipt, as the Lambda does
+                self.store(source, merge_results([got[custom_id] for custom_id in ids]))
+
+            pending += 1
+            if pending >= SAVE_EVERY:
+                self.checkpoint.save()
+                pending = 0
+
+        del self.checkpoint.batches[batch_id]
+        self.checkpoint.save()
+        print(f"✅ Collected batch {batch_id}")
+
+    def store(self, source: str, result_str: str):
+        row = app.store_result(self.key(source), result_str, table=self.table,
+                               categorizer=self.categorizer, categories=self.categories)
+        if any(item.get("categoryPending") for item in row.get("items", [])):
+            self.checkpoint.pending.append([row["userId"], row["date"]])
+        self.checkpoint.done.add(source)
+        self.stats["stored"] += 1
+
+    def categorize_pending(self):
+        """
+        Categorize every pending item in one message batch and rewrite their rows.
+        Rows whose request fails keep their fallback categories and stay pending
+        for the next run.
+        """
+        if not self.checkpoint.pending or self.categorizer is None:
+            return
+        table = self.table if self.table is not None else app.ddb
+        allowed = self.categorizer.allowed(self.categories)
+
+        rows = {}
+        for user_id, date in self.checkpoint.pending:
+            row = table.get_item(Key={"userId": user_id, "date": date}).get("Item")
+            if row and pending_names(row):
+                rows[custom_id_for(f"{user_id}|{date}")] = row
+
+        batch_id = self.checkpoint.category_batch
+        if batch_id is None:
+            if not rows:
+                self.checkpoint.pending = []
+                return
+            requests = [self.categorizer.batch_request(custom_id, pending_names(row), allowed)
+                        for custom_id, row in rows.items()]
+            batch_id = self.claude.client.messages.batches.create(requests=requests).id
+            self.checkpoint.category_batch = batch_id
+            self.checkpoint.save()
+            print(f"Submitted categorization batch {batch_id} ({len(requests)} receipts)")
+        self.wait(batch_id)
+
+        for entry in self.claude.client.messages.batches.results(batch_id):
+            row = rows.get(entry.custom_id)
+            if row is None or entry.result.type != "succeeded":
+                continue
+            names = pending_names(row)
+            answers = self.categorizer.parse_answers(entry.result.message.content[0].text, names, allowed)
+            for name in names:
+                group = [i for i in row["items"] if i.get("categoryPending") and i.get("name", "") == name]
+                if name in answers:
+                    self.categorizer.resolve(group, answers[name], row.get("vendor"))
+                else:
+                    for item in group:
+                        item.pop("categoryPending")    # unusable answer: keep the fallback
+            row["category"] = app.top_category(row["items"])
+            table.put_item(Item=row)
+            self.stats["categorized"] += 1
+
+        self.checkpoint.pending = [[r["userId"], r["date"]] for r in rows.values() if pending_names(r)]
+        self.checkpoint.category_batch = None
+        self.checkpoint.save()
+        print(f"✅ Categorized pending items from batch {batch_id}")
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Backfill receipts through the Message Batches API")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--manifest", help="file with one s3://bucket/key or local path per line")
+    source.add_argument("--s3-prefix", help="s3://bucket/prefix to ingest")
+    parser.add_argument("--user-id", default=None, help="user the receipts belong to (required for local files)")
+    parser.add_argument("--checkpoint", default="batch_checkpoint.json")
+    parser.add_argument("--categories", default="", help="comma separated category names (default RECEIPT_CATEGORIES)")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    parser.add_argument("--poll-interval", type=float, default=POLL_INTERVAL)
+    parser.add_argument("--base-url", default=None, help="override the Anthropic API base URL")
+    args = parser.parse_args(argv)
+
+    ingestor = BatchIngestor(
+        ClaudeWrapper(base_url=args.base_url),
+        Checkpoint(args.checkpoint),
+        user_id=args.user_id,
+        categories=[c.strip() for c in args.categories.split(",") if c.strip()] or None,
+        chunk_size=args.chunk_size,
+        poll_interval=args.poll_interval,
+    )
+    stats = ingestor.run(list_sources(manifest=args.manifest, s3_prefix=args.s3_prefix))
+    print(json.dumps(stats))
+    return stats
+
+
+if __name__ == "__main__":
+    main()
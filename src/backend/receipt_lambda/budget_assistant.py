@@ -0,0 +1,255 @@
+# budget_assistant.py
+"""
+Natural-language budget Q&A over a user's transactions.
+
+Claude never sees the transaction list. It answers by calling local tools
+(sum_spend, top_vendors, spend_by_category) that read from TransactionIndex,
+which keeps per-category and per-vendor running totals over sorted days, so
+each call is a couple of bisects and the prompt stays the same size however
+long the history is. Amounts are kept in integer cents so answers are exact.
+Questions go through a ConversationManager, so follow-ups ("and the month
+before?") keep the earlier questions and answers in context.
+"""
+import time
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from decimal import Decimal, ROUND_HALF_UP
+from heapq import nlargest
+from typing import Dict, List, Optional
+
+from claude_wrapper import ClaudeWrapper, ConversationManager
+from multi_receipt import to_amount
+
+TAXES_AND_FEES = "Taxes & Fees"   # category for receipt taxes/fees, which aren't itemized
+MAX_TOOL_ROUNDS = 6
+
+
+def to_cents(amount) -> int:
+    return int((Decimal(str(amount)) * 100).quantize(Decimal("1"), rounding=ROUND_HALF_UP))
+
+def from_cents(cents: int) -> float:
+    return cents / 100
+
+
+class _RunningTotals:
+    """Per-day totals for one key with prefix sums for O(log n) range queries."""
+
+    def __init__(self, by_day: Dict[str, int]):
+        self.days = sorted(by_day)
+        self.cumulative = [0]
+        for day in self.days:
+            self.cumulative.append(self.cumulative[-1] + by_day[day])
+
+    def total(self, start: Optional[str], end: Optional[str]) -> int:
+        lo = bisect_left(self.days, start) if start else 0
+        hi = bisect_right(self.days, end) if end else len(self.days)
+        return self.cumulative[hi] - self.cumulative[lo] if hi > lo else 0
+
+
+class TransactionIndex:
+    """
+    Indexed spending aggregates for one user.
+
+    Build with from_transactions (frontend state) or from_receipts (DynamoDB
+    receipt rows); dates are ISO strings (YYYY-MM-DD) and ranges are inclusive.
+    """
+
+    def __init__(self):
+        self._category_days = defaultdict(lambda: defaultdict(int))
+        self._vendor_days = defaultdict(lambda: defaultdict(int))
+        self._categories: Dict[str, _RunningTotals] = {}
+        self._vendors: Dict[str, _RunningTotals] = {}
+        self.count = 0
+        self.newest: Optional[str] = None   # newest receipt sort key indexed, for incremental loads
+        self.loaded_at = time.time()
+
+    def add(self, date: str, amount, category: Optional[str] = None, vendor: Optional[str] = None):
+        cents = to_cents(amount)
+        day = str(date)[:10]
+        self._category_days[category or "Other"][day] += cents
+        self._vendor_days[vendor or "Unknown"][day] += cents
+        self.count += 1
+        self._categories, self._vendors = {}, {}   # rebuilt lazily
+
+    @classmethod
+    def from_transactions(cls, transactions: List[Dict]) -> "TransactionIndex":
+        """Index frontend transactions: {"name", "amount", "date", "category"}"""
+        index = cls()
+        for t in transactions:
+            if t.get("type", "expense") != "expense":
+                continue
+            index.add(t["date"], t.get("amount", 0), t.get("category"), t.get("name") or t.get("description"))
+        return index
+
+    @classmethod
+    def from_receipts(cls, receipts: List[Dict]) -> "TransactionIndex":
+        """Index parsed receipt rows as written by app.store_result; unreadable amounts count as 0"""
+        index = cls()
+        index.add_receipts(receipts)
+        return index
+
+    def add_receipts(self, receipts: List[Dict]):
+        for r in receipts:
+            if self.newest is None or r["date"] > self.newest:
+                self.newest = r["date"]
+            if r.get("status") != "parsed":
+                continue
+            for item in r.get("items", []):
+                self.add(r["date"], to_amount(item.get("cost")) or 0, item.get("category"), r.get("vendor"))
+            extra = (to_amount(r.get("taxes")) or 0) + (to_amount(r.get("fees")) or 0)
+            if extra:
+                self.add(r["date"], extra, TAXES_AND_FEES, r.get("vendor"))
+
+    def _totals(self, which: str) -> Dict[str, _RunningTotals]:
+        built = self._categories if which == "category" else self._vendors
+        if not built:
+            days = self._category_days if which == "category" else self._vendor_days
+            built.update({key: _RunningTotals(by_day) for key, by_day in days.items()})
+        return built
+
+    def categories(self) -> List[str]:
+        return sorted(self._category_days)
+
+    def sum_spend(self, category: Optional[str] = None, start: Optional[str] = None, end: Optional[str] = None) -> int:
+        """Total cents spent in a category (or overall) between start and end"""
+        totals = self._totals("category")
+        if category is None:
+            return sum(t.total(start, end) for t in totals.values())
+        match = self._lookup(totals, category)
+        return match.total(start, end) if match else 0
+
+    def spend_by_category(self, start: Optional[str] = None, end: Optional[str] = None) -> Dict[str, int]:
+        totals = {c: t.total(start, end) for c, t in self._totals("category").items()}
+        return {c: cents for c, cents in sorted(totals.items(), key=lambda kv: -kv[1]) if cents}
+
+    def top_vendors(self, n: int = 5, start: Optional[str] = None, end: Optional[str] = None) -> List[tuple]:
+        """(vendor, cents) for the n vendors with the most spend in range"""
+        totals = ((v, t.total(start, end)) for v, t in self._totals("vendor").items())
+        return [(v, cents) for v, cents in nlargest(n, totals, key=lambda vt: vt[1]) if cents]
+
+    @staticmethod
+    def _lookup(totals: Dict[str, _RunningTotals], name: str) -> Optional[_RunningTotals]:
+        if name in totals:
+            return totals[name]
+        folded = name.casefold()
+        return next((t for key, t in totals.items() if key.casefold() == folded), None)
+
+
+def load_user_index(table, user_id: str, index: Optional[TransactionIndex] = None) -> TransactionIndex:
+    """
+    Build a user's index from the receipts table (userId PK, date SK), or bring
+    `index` up to date by reading only the rows sorted after its newest one.
+    Only parsed rows, and only the attributes the index uses, are read.
+    """
+    from boto3.dynamodb.conditions import Attr, Key
+
+    key = Key("userId").eq(user_id)
+    if index is None:
+        index = TransactionIndex()
+    elif index.newest is not None:
+        key = key & Key("date").gt(index.newest)
+
+    kwargs = {
+        "KeyConditionExpression": key,
+        "FilterExpression": Attr("status").eq("parsed"),
+        "ProjectionExpression": "#d, #s, vendor, #i, taxes, fees",
+        "ExpressionAttributeNames": {"#d": "date", "#s": "status", "#i": "items"},
+    }
+    while True:
+        page = table.query(**kwargs)
+        index.add_receipts(page.get("Items", []))
+        if "LastEvaluatedKey" not in page:
+            return index
+        kwargs["ExclusiveStartKey"] = page["LastEvaluatedKey"]
+        kwargs["ExclusiveStartKey"] = page["LastEvaluatedKey"]
+
+
+DATE_RANGE_PROPS = {
+    "start_date": {"type": "string", "description": "First day included, YYYY-MM-DD. Omit for no lower bound."},
+    "end_date": {"type": "string", "description": "Last day included, YYYY-MM-DD. Omit for no upper bound."},
+}
+
+TOOLS = [
+    {
+        "name": "sum_spend",
+        "description": "Exact total spent in one category (or across all categories) over a date range.",
+        "input_schema": {
+            "type": "object",
+            "properties": {
+                "category": {"type": "string", "description": "Category name; omit for all spending."},
+                **DATE_RANGE_PROPS,
+            },
+        },
+    },
+    {
+        "name": "top_vendors",
+        "description": "Vendors with the most spending over a date range, largest first.",
+        "input_schema": {
+            "type": "object",
+            "properties": {
+                "n": {"type": "integer", "description": "How many vendors to return (default 5)."},
+                **DATE_RANGE_PROPS,
+            },
+        },
+    },
+    {
+        "name": "spend_by_category",
+        "description": "Exact spending per category over a date range, largest first.",
+        "input_schema": {"type": "object", "properties": {**DATE_RANGE_PROPS}},
+    },
+]
+
+
+class BudgetAssistant:
+    """
+    Answers spending questions with tool calls against a TransactionIndex.
+
+    One assistant is one conversation; `index` may be swapped for a fresher
+    one between questions.
+    """
+
+    def __init__(self, claude_wrapper: ClaudeWrapper, index: TransactionIndex, today: Optional[str] = None):
+        self.claude = claude_wrapper
+        self.index = index
+        self.fixed_today = today
+        self.conversation = ConversationManager(claude_wrapper, self.system_prompt())
+
+    @property
+    def today(self) -> str:
+        return self.fixed_today or time.strftime("%Y-%m-%d", time.gmtime())
+
+    def system_prompt(self) -> str:
+        return (
+            "You are a budgeting assistant. Answer questions about the user's spending using the tools; "
+            "never guess amounts. Resolve relative dates (\"last month\", \"this week\") to explicit "
+            f"YYYY-MM-DD ranges. Today is {self.today}. "
+            f"Known categories: {', '.join(self.index.categories()) or 'none yet'}. "
+            "Amounts from tools are in dollars. Answer briefly."
+        )
+
+    def run_tool(self, name: str, args: Dict) -> Dict:
+        start, end = args.get("start_date"), args.get("end_date")
+        if name == "sum_spend":
+            return {"total": from_cents(self.index.sum_spend(args.get("category"), start, end))}
+        if name == "top_vendors":
+            vendors = self.index.top_vendors(int(args.get("n", 5)), start, end)
+            return {"vendors": [{"vendor": v, "total": from_cents(c)} for v, c in vendors]}
+        if name == "spend_by_category":
+            return {"categories": {c: from_cents(cents) for c, cents in self.index.spend_by_category(start, end).items()}}
+        raise ValueError(f"Unknown tool: {name}")
+
+    def ask(self, question: str, max_tokens: int = 1024) -> str:
+        """
+        Answer a spending question
+
+        Args:
+            question: e.g. "How much did I spend on dining last month?", or a follow-up
+            max_tokens: Maximum tokens per model response
+
+        Returns:
+            Claude's answer as string
+        """
+        # categories (and the date) can change between questions
+        self.conversation.system_prompt = self.system_prompt()
+        return self.conversation.send_message_with_tools(
+            question, TOOLS, self.run_tool, max_rounds=MAX_TOOL_ROUNDS, max_tokens=max_tokens)
@@ -0,0 +1,412 @@
+# categorizer.py
+"""
+Local category assignment for receipt line items.
+
+CategoryIndex learns normalized item name -> category from past extractions
+and user corrections, and scores unseen names by their tokens. Categorizer
+fills in every item it is confident about and sends only the ambiguous ones
+to Claude, together, in one small text-only call. With defer=True (bulk
+ingestion) that call is skipped: ambiguous items get a fallback category and
+are flagged categoryPending, to be resolved later in one message batch
+(batch_request / parse_answers).
+
+Shared state lives under one S3 prefix: index.json (written by whoever
+learned something) and corrections.json (written by the API when a user
+re-categorizes an item, read back by the Lambda on every invocation).
+Both are updated read-modify-write with conditional puts (If-Match on the
+ETag read), retried on conflict, so concurrent Lambdas and API requests
+don't drop each other's changes.
+"""
+import os, re, json, math
+from collections import Counter, defaultdict
+from typing import Callable, Dict, List, Optional, Tuple
+
+import anthropic
+
+from claude_wrapper import ClaudeWrapper
+
+CONFIDENCE_THRESHOLD = float(os.environ.get("CATEGORY_CONFIDENCE", "0.75"))
+CORRECTION_WEIGHT    = 5   # a user correction counts as this many observations
+EVIDENCE_SCALE       = 2.0 # IDF weight of known tokens at which fuzzy confidence reaches ~63% of agreement
+INDEX_OBJECT         = "index.json"
+CORRECTIONS_OBJECT   = "corrections.json"
+WRITE_ATTEMPTS       = 5   # conditional S3 writes retried this many times on conflict
+
+# sizes, counts and units that say nothing about the category ("14 oz", "6 pack")
+NOISE_RE = re.compile(r"\b\d+(\.\d+)?\s*(oz|lb|lbs|g|kg|ml|l|ct|pk|pack|pc|pcs|x)?\b")
+# ```json ... ``` around a reply, which the prompt asks the model to leave out
+FENCE_RE = re.compile(r"^```[a-z]*\s*|\s*```$", re.I)
+STOPWORDS = {"a", "an", "and", "the", "of", "with", "w", "for", "in", "extra", "large", "small", "medium", "lg", "sm", "med"}
+
+
+def normalize_name(name: str) -> str:
+    name = name.lower().replace("'", "")
+    name = NOISE_RE.sub(" ", name)
+    name = re.sub(r"[^a-z ]+", " ", name)
+    return " ".join(name.split())
+
+def name_tokens(normalized: str) -> List[str]:
+    # crude singularization so "pizzas"/"pizza" share a token
+    return [t[:-1] if len(t) > 3 and t.endswith("s") and not t.endswith("ss") else t
+            for t in normalized.split() if t not in STOPWORDS]
+
+
+class CategoryIndex:
+    """Normalized-name -> category statistics with a token index for fuzzy matches."""
+
+    def __init__(self):
+        self.names: Dict[str, Counter] = defaultdict(Counter)
+        self.vendor_names: Dict[str, str] = {}     # "vendor|name" -> category
+        self.corrections: Dict[str, str] = {}      # name -> category set by the user
+        self.tokens: Dict[str, Counter] = defaultdict(Counter)
+        self.observations = 0
+        self.unsaved = Counter()                   # (name, category, vendor) -> weight learned since the last save_index
+
+    def learn(self, name: str, category: str, vendor: Optional[str] = None, weight: int = 1):
+        """Record one extraction of `name` as `category`"""
+        key = normalize_name(name)
+        if not key or not category:
+            return
+        self.names[key][category] += weight
+        if vendor:
+            self.vendor_names[f"{normalize_name(vendor)}|{key}"] = category
+        for token in set(name_tokens(key)):
+            self.tokens[token][category] += weight
+        self.observations += weight
+        self.unsaved[key, category, vendor] += weight
+
+    def correct(self, name: str, category: str, vendor: Optional[str] = None):
+        """Record a user correction; it wins over learned statistics for this name"""
+        self.corrections[normalize_name(name)] = category
+        self.learn(name, category, vendor, weight=CORRECTION_WEIGHT)
+
+    def apply_corrections(self, corrections: Dict[str, Dict]) -> bool:
+        """
+        Apply corrections as stored by save_correction; ones already applied are skipped.
+
+        Returns:
+            True if anything changed
+        """
+        changed = False
+        for key, correction in corrections.items():
+            if self.corrections.get(key) != correction["category"]:
+                self.correct(key, correction["category"], correction.get("vendor"))
+                changed = True
+        return changed
+
+    def learn_receipt(self, receipt: Dict):
+        """Learn every categorized item of a parsed receipt (skips "Other")"""
+        for item in receipt.get("items", []):
+            if item.get("category") and item["category"] != "Other":
+                self.learn(item.get("name", ""), item["category"], receipt.get("vendor"))
+
+    def match(self, name: str, categories: List[str] = [], vendor: Optional[str] = None) -> Tuple[Optional[str], float]:
+        """
+        Best category for an item name.
+
+        Args:
+            name: Item name as extracted
+            categories: Allowed categories (empty = any)
+            vendor: Vendor name, used for exact per-vendor hits
+
+        Returns:
+            (category or None, confidence in [0, 1])
+        """
+        key = normalize_name(name)
+        if not key:
+            return None, 0.0
+        allowed = (lambda c: c in categories) if categories else (lambda c: True)
+
+        if key in self.corrections and allowed(self.corrections[key]):
+            return self.corrections[key], 1.0
+
+        if vendor:
+            category = self.vendor_names.get(f"{normalize_name(vendor)}|{key}")
+            if category and allowed(category):
+                return category, 1.0
+
+        if key in self.names:
+            counts = {c: n for c, n in self.names[key].items() if allowed(c)}
+            if counts:
+                best = max(counts, key=counts.get)
+                return best, counts[best] / sum(self.names[key].values())
+
+        return self._fuzzy(name_tokens(key), allowed)
+
+    def _fuzzy(self, tokens: List[str], allowed) -> Tuple[Optional[str], float]:
+        """IDF-weighted token vote: confidence = agreement between categories x strength of known evidence"""
+        if not tokens or not self.observations:
+            return None, 0.0
+
+        scores = Counter()
+        known_weight = 0.0
+        for token in tokens:
+            counts = self.tokens.get(token)
+            if not counts:
+                continue
+            seen = sum(counts.values())
+            weight = math.log(1 + self.observations / seen)
+            known_weight += weight
+            for category, n in counts.items():
+                if allowed(category):
+                    scores[category] += weight * n / seen
+
+        if not scores:
+            return None, 0.0
+        best, score = scores.most_common(1)[0]
+        return best, (score / sum(scores.values())) * (1 - math.exp(-known_weight / EVIDENCE_SCALE))
+
+    def to_dict(self) -> Dict:
+        return {
+            "names": {k: dict(v) for k, v in self.names.items()},
+            "vendorNames": self.vendor_names,
+            "corrections": self.corrections,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "CategoryIndex":
+        index = cls()
+        for key, counts in data.get("names", {}).items():
+            for category, n in counts.items():
+                index.learn(key, category, weight=n)
+        index.vendor_names.update(data.get("vendorNames", {}))
+        index.corrections.update(data.get("corrections", {}))
+        index.unsaved.clear()
+        return index
+
+    def save(self, path: str):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f)
+
+    @classmethod
+    def load(cls, path: str) -> "CategoryIndex":
+        """Load an index saved with save(); a missing file gives an empty index"""
+        if not os.path.exists(path):
+            return cls()
+        with open(path, "r", encoding="utf-8") as f:
+            return cls.from_dict(json.load(f))
+
+
+def _location(uri: str, name: str) -> Tuple[str, str]:
+    bucket, _, prefix = uri[len("s3://"):].partition("/")
+    return bucket, f"{prefix.rstrip('/')}/{name}" if prefix.strip("/") else name
+
+def _read_json(s3, uri: str, name: str) -> Tuple[Optional[Dict], Optional[str]]:
+    """(data, ETag), or (None, None) if the object doesn't exist"""
+    from botocore.exceptions import ClientError
+
+    bucket, key = _location(uri, name)
+    try:
+        obj = s3.get_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") in ("NoSuchKey", "404"):
+            return None, None
+        raise
+    return json.loads(obj["Body"].read()), obj.get("ETag")
+
+def _update_json(s3, uri: str, name: str, update: Callable[[Optional[Dict]], Dict]):
+    """
+    Write update(current data) back only if nobody wrote in between (If-Match on
+    the ETag, or If-None-Match for a new object); re-read and retry if they did.
+    """
+    from botocore.exceptions import ClientError
+
+    bucket, key = _location(uri, name)
+    for attempt in range(WRITE_ATTEMPTS):
+        data, etag = _read_json(s3, uri, name)
+        condition = {"IfMatch": etag} if etag else {"IfNoneMatch": "*"}
+        try:
+            s3.put_object(Bucket=bucket, Key=key, Body=json.dumps(update(data)),
+                          ContentType="application/json", **condition)
+            return
+        except ClientError as e:
+            code = e.response.get("Error", {}).get("Code")
+            if code not in ("PreconditionFailed", "ConditionalRequestConflict", "NoSuchKey", "412", "409") \
+                    or attempt == WRITE_ATTEMPTS - 1:
+                raise
+
+def load_index(s3, uri: str, seed_path: Optional[str] = None) -> CategoryIndex:
+    """
+    Load the shared index from s3://bucket/prefix, with its corrections applied.
+
+    Args:
+        seed_path: Local index (CategoryIndex.save) to start from when none is stored yet
+    """
+    data, _ = _read_json(s3, uri, INDEX_OBJECT)
+    if data is not None:
+        index = CategoryIndex.from_dict(data)
+    else:
+        index = CategoryIndex.load(seed_path) if seed_path else CategoryIndex()
+    index.apply_corrections(load_corrections(s3, uri))
+    return index
+
+def save_index(s3, uri: str, index: CategoryIndex):
+    """
+    Add what `index` learned since its last save to the stored index (or store
+    it whole if there is none yet), keeping what other writers added meanwhile.
+    """
+    unsaved = Counter(index.unsaved)
+
+    def merge(stored: Optional[Dict]) -> Dict:
+        if stored is None:
+            return index.to_dict()
+        merged = CategoryIndex.from_dict(stored)
+        for (key, category, vendor), weight in unsaved.items():
+            merged.learn(key, category, vendor, weight)
+        merged.corrections.update(index.corrections)
+        return merged.to_dict()
+
+    _update_json(s3, uri, INDEX_OBJECT, merge)
+    index.unsaved -= unsaved   # keeps anything learned while the write was in flight
+
+def load_corrections(s3, uri: str) -> Dict[str, Dict]:
+    """{normalized name: {"category", "vendor"}} recorded with save_correction"""
+    return _read_json(s3, uri, CORRECTIONS_OBJECT)[0] or {}
+
+def save_correction(s3, uri: str, name: str, category: str, vendor: Optional[str] = None) -> str:
+    """
+    Record a user's category for an item name; the latest one per name wins.
+
+    Returns:
+        The normalized name it was stored under
+
+    Raises:
+        ValueError: if the name has nothing left after normalizing, or category is empty
+    """
+    key = normalize_name(name)
+    if not key or not category:
+        raise ValueError("name and category are required")
+    _update_json(s3, uri, CORRECTIONS_OBJECT,
+                 lambda corrections: {**(corrections or {}), key: {"category": category, "vendor": vendor}})
+    return key
+
+
+class Categorizer:
+    """Assigns item categories locally, asking Claude only about ambiguous names."""
+
+    def __init__(self, claude_wrapper: ClaudeWrapper, index: CategoryIndex, threshold: float = CONFIDENCE_THRESHOLD,
+                 defer: bool = False):
+        """
+        Args:
+            claude_wrapper: ClaudeWrapper used for ambiguous names
+            index: CategoryIndex to match against and learn into
+            threshold: Confidence needed to accept a local match
+            defer: Don't call the model; flag ambiguous items "categoryPending" instead
+        """
+        self.claude = claude_wrapper
+        self.index = index
+        self.threshold = threshold
+        self.defer = defer
+
+    def categorize(self, items: List[Dict], categories: List[str], vendor: Optional[str] = None) -> Dict[str, int]:
+        """
+        Set item["category"] for each item, in place.
+
+        Ambiguous items the model can't be asked about (deferred, or the call
+        failed) keep the category they were extracted with if it is allowed,
+        otherwise "Other".
+
+        Args:
+            items: Receipt items with a "name"
+            categories: Allowed categories ("Other" is always allowed)
+            vendor: Receipt vendor
+
+        Returns:
+            Counts of items resolved "local", by "model", and left "pending"
+        """
+        allowed = self.allowed(categories)
+        ambiguous: Dict[str, List[Dict]] = {}
+
+        for item in items:
+            category, confidence = self.index.match(item.get("name", ""), allowed, vendor)
+            if category and confidence >= self.threshold:
+                item["category"] = category
+            else:
+                ambiguous.setdefault(item.get("name", ""), []).append(item)
+
+        answers = {}
+        if ambiguous and not self.defer:
+            try:
+                answers = self._ask_model(list(ambiguous), allowed)
+            except anthropic.APIError as e:
+                print(f"❌ Categorizing {len(ambiguous)} items failed, using fallbacks: {e}")
+
+        pending = 0
+        for name, group in ambiguous.items():
+            if name in answers:
+                self.resolve(group, answers[name], vendor)
+                continue
+            for item in group:
+                item["category"] = item.get("category") if item.get("category") in allowed else "Other"
+                if self.defer:
+                    item["categoryPending"] = True
+                    pending += 1
+
+        model_items = sum(len(group) for name, group in ambiguous.items() if name in answers)
+        return {"local": len(items) - sum(len(group) for group in ambiguous.values()),
+                "model": model_items, "pending": pending}
+
+    def resolve(self, items: List[Dict], category: str, vendor: Optional[str] = None):
+        """Apply the model's answer for one name to its items and learn it"""
+        for item in items:
+            item["category"] = category
+            item.pop("categoryPending", None)
+        if category != "Other" and items:
+            self.index.learn(items[0].get("name", ""), category, vendor)
+
+    @staticmethod
+    def allowed(categories: List[str]) -> List[str]:
+        return list(categories) + (["Other"] if "Other" not in categories else [])
+
+    @staticmethod
+    def prompt(names: List[str], categories: List[str]) -> str:
+        numbered = "\n".join(f"{i}. {name}" for i, name in enumerate(names, 1))
+        return f'''Assign each receipt item below to one of these categories: {categories}
+Do not invent new categories. If nothing fits, use "Other".
+Return only a json object mapping the item number to its category, like {{"1": "Food", "2": "Other"}}
+(no code fences, and do NOT include json in the beginning of the string).
+
+{numbered}'''
+
+    @staticmethod
+    def parse_answers(response: str, names: List[str], categories: List[str]) -> Dict[str, str]:
+        """Model reply -> {name: category}; anything unusable becomes "Other" """
+        try:
+            mapping = json.loads(FENCE_RE.sub("", response.strip()))
+        except json.JSONDecodeError:
+            return {}
+        if not isinstance(mapping, dict):
+            return {}
+
+        answers = {}
+        for i, name in enumerate(names, 1):
+            category = mapping.get(str(i))
+            answers[name] = category if category in categories else "Other"
+        return answers
+
+    def _ask_model(self, names: List[str], categories: List[str]) -> Dict[str, str]:
+        """One text-only call for all ambiguous names"""
+        response = self.claude.chat(self.prompt(names, categories), max_tokens=20 * len(names) + 50, temperature=0)
+        return self.parse_answers(response, names, categories)
+
+    def batch_request(self, custom_id: str, names: List[str], categories: List[str]) -> Dict:
+        """
+        The same question as a Message Batches API request entry, for pending items.
+
+        Args:
+            custom_id: Identifier echoed back with the result
+            names: Ambiguous item names
+            categories: Allowed categories, "Other" included
+
+        Returns:
+            Request dict for messages.batches.create; answer with parse_answers
+        """
+        return {
+            "custom_id": custom_id,
+            "params": {
+                "model": self.claude.model,
+                "max_tokens": 20 * len(names) + 50,
+                "temperature": 0,
+                "messages": [{"role": "user", "content": self.prompt(names, categories)}],
+            }
+        }
@@ -1,23 +1,25 @@
 import anthropic
+import json
 import os
 import base64
-from typing import List, Dict, Optional, AsyncGenerator, Union
+from typing import Callable, List, Dict, Optional, AsyncGenerator, Union
 import asyncio
 
 class ClaudeWrapper:
-    def __init__(self, api_key: Optional[str] = None):
+    def __init__(self, api_key: Optional[str] = None, base_url: Optional[str] = None):
         """
         Initialize Claude wrapper
         
         Args:
             api_key: Your Anthropic API key. If None, will look for ANTHROPIC_API_KEY env var
+            base_url: Optional API base URL (e.g. a local stand-in server for tests)
         """
         self.api_key = api_key or os.getenv('ANTHROPIC_API_KEY')
         if not self.api_key:
             raise ValueError("API key required. Set ANTHROPIC_API_KEY env var or pass api_key parameter")
         
-        self.client = anthropic.Anthropic(api_key=self.api_key)
-        self.async_client = anthropic.AsyncAnthropic(api_key=self.api_key)
+        self.client = anthropic.Anthropic(api_key=self.api_key, base_url=base_url)
+        self.async_client = anthropic.AsyncAnthropic(api_key=self.api_key, base_url=base_url)
         
         # Claude Sonnet 4 model string
         self.model = "claude-sonnet-4-20250514"
@@ -52,10 +54,10 @@ class ClaudeWrapper:
         return response.content[0].text
 
     def chat_with_history(self,
-                         messages: List[Dict[str, str]],
+                         messages: List[Dict],
                          max_tokens: int = 4096,
                          temperature: float = 0.7,
-                         system: Optional[str] = None) -> str:
+                         system: Optional[Union[str, List[Dict]]] = None) -> str:
         """
         Chat with conversation history
         
@@ -63,7 +65,7 @@ class ClaudeWrapper:
             messages: List of message dicts with 'role' and 'content' keys
             max_tokens: Maximum tokens in response
             temperature: Response creativity (0-1)
-            system: System prompt
+            system: System prompt, as a string or a list of text blocks
             
         Returns:
             Claude's response as string
@@ -72,12 +74,40 @@ class ClaudeWrapper:
             model=self.model,
             max_tokens=max_tokens,
             temperature=temperature,
-            system=system,
+            system=system or anthropic.NOT_GIVEN,
             messages=messages
         )
         
         return response.content[0].text
     
+    def chat_with_tools(self,
+                        messages: List[Dict],
+                        tools: List[Dict],
+                        max_tokens: int = 1024,
+                        temperature: float = 0,
+                        system: Optional[Union[str, List[Dict]]] = None):
+        """
+        Chat with tools the model may call
+        
+        Args:
+            messages: List of message dicts with 'role' and 'content' keys
+            tools: Tool definitions (name, description, input_schema)
+            max_tokens: Maximum tokens in response
+            temperature: Response creativity (0-1)
+            system: System prompt, as a string or a list of text blocks
+            
+        Returns:
+            The full API response; check stop_reason == "tool_use" for tool calls
+        """
+        return self.client.messages.create(
+            model=self.model,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            system=system or anthropic.NOT_GIVEN,
+            tools=tools,
+            messages=messages
+        )
+    
     def stream_chat(self,
                    message: str,
                    max_tokens: int = 4096,
@@ -134,21 +164,35 @@ class ClaudeWrapper:
         
         return media_type, base64_data
 
-    def read_receipt(self, base64_input: str, categories: list = [], max_tokens: int = 4096) -> str:
+    def _receipt_messages(self, base64_input: str, categories: Optional[list] = []) -> List[Dict]:
         """
-        Process a receipt image (as base64 string) and extract itemized information.
-        
+        Build the messages payload used to extract a receipt.
+
         Args:
-            base64_input: A base64-encoded image string (e.g., from mobile app or API).
-            max_tokens: Maximum tokens in response.
-            
+            base64_input: A base64-encoded image string.
+            categories: Categories the model may assign to items. None leaves
+                categorization out of the prompt (items are categorized afterwards).
+
         Returns:
-            JSON string with receipt data (with categories added) or 'None' if not a receipt.
+            List of message dicts ready for messages.create
         """
 
         # Assume base64 input is always JPEG unless otherwise specified
         media_type = "image/jpeg"
-        
+
+        category_rules = "" if categories is None else f'''
+        Also Follow these Category rules:
+        - Add categories to each item
+        - The available categories are {categories}, Do not invent new categories.
+        - If there it does not match one of the categories, put it in "Other"
+'''
+        if categories is None:
+            example_items = '''{"name": "Coffee", "cost": 3.50},
+            {"name": "Notebook", "cost": 5.00}'''
+        else:
+            example_items = '''{"name": "Coffee", "cost": 3.50, "category": "Food"},
+            {"name": "Notebook", "cost": 5.00, "category": "Stationary"}'''
+
         system_prompt = f'''
         Given this receipt, follow the rules below to generate a json string (do NOT include json in the beginning of the string)
         
@@ -158,20 +202,14 @@ class ClaudeWrapper:
         3. Do NOT give a description of the item or the payment method.
         4. Include the vendor name.
         5. Include the date of the transaction, if not visible use today's date
-
-        Also Follow these Category rules:
-        - Add categories to each item
-        - The available categories are {categories}, Do not invent new categories.
-        - If there it does not match one of the categories, put it in "Other"
-
+        {category_rules}
         If the image is not a receipt, simply return the string "None" and NOTHING ELSE
         ''' + '''\
         The outputted json string should follow a format like this:
         {
         "date": "2025-09-13",
         "items": [
-            {"name": "Coffee", "cost": 3.50, "category": "Food"},
-            {"name": "Notebook", "cost": 5.00, "category": "Stationary"}
+            ''' + example_items + '''
         ],
          "subtotal": 8.50,
          "taxes": 0.50,
@@ -180,7 +218,7 @@ class ClaudeWrapper:
         }
         '''
         # Create message with image
-        messages = [{
+        return [{
             "role": "user",
             "content": [
                 {
@@ -197,14 +235,48 @@ class ClaudeWrapper:
                 }
             ]
         }]
+
+    def read_receipt(self, base64_input: str, categories: Optional[list] = [], max_tokens: int = 4096) -> str:
+        """
+        Process a receipt image (as base64 string) and extract itemized information.
         
+        Args:
+            base64_input: A base64-encoded image string (e.g., from mobile app or API).
+            categories: Categories the model may assign to items; None to leave items uncategorized.
+            max_tokens: Maximum tokens in response.
+            
+        Returns:
+            JSON string with receipt data (with categories added) or 'None' if not a receipt.
+        """
         response = self.client.messages.create(
             model=self.model,
             max_tokens=max_tokens,
-            messages=messages
+            messages=self._receipt_messages(base64_input, categories)
         )
         
         return response.content[0].text
+
+    def receipt_batch_request(self, custom_id: str, base64_input: str, categories: Optional[list] = [], max_tokens: int = 4096) -> Dict:
+        """
+        Build one Message Batches API request entry for a receipt image.
+        
+        Args:
+            custom_id: Identifier echoed back with the result (^[a-zA-Z0-9_-]{1,64}$)
+            base64_input: A base64-encoded image string.
+            categories: Categories the model may assign to items; None to leave items uncategorized.
+            max_tokens: Maximum tokens in response.
+            
+        Returns:
+            Request dict for messages.batches.create
+        """
+        return {
+            "custom_id": custom_id,
+            "params": {
+                "model": self.model,
+                "max_tokens": max_tokens,
+                "messages": self._receipt_messages(base64_input, categories)
+            }
+        }
     
     async def async_stream_chat(self,
                                message: str,
@@ -272,41 +344,208 @@ class ClaudeWrapper:
         return response.content[0].text
 
 
+def estimate_tokens(content: Union[str, List[Dict]]) -> int:
+    """Rough token count (~4 characters per token) used for budget checks"""
+    if isinstance(content, list):
+        return sum(estimate_tokens(block.get("text", "")) for block in content)
+    return len(content) // 4 + 1
+
+
+SUMMARY_SYSTEM_PROMPT = """You maintain a running summary of a conversation between a user and an assistant.
+Merge the new turns into the existing summary. Keep facts, numbers, decisions and open questions; drop pleasantries.
+Reply with the updated summary only."""
+
+
 class ConversationManager:
-    """Helper class to manage conversation history"""
+    """
+    Helper class to manage conversation history
+
+    Recent turns are kept verbatim. Once they exceed `token_budget`, the oldest
+    turns are folded into a running summary that is sent as part of the system
+    prompt, so the context sent per turn stops growing. The system prompt +
+    summary and the conversation up to the latest user turn are marked for
+    prompt caching.
+    """
     
-    def __init__(self, claude_wrapper: ClaudeWrapper, system_prompt: Optional[str] = None):
+    def __init__(self,
+                 claude_wrapper: ClaudeWrapper,
+                 system_prompt: Optional[str] = None,
+                 token_budget: int = 8000,
+                 keep_recent: int = 4,
+                 summary_max_tokens: int = 512):
+        """
+        Args:
+            claude_wrapper: ClaudeWrapper used for replies and summaries
+            system_prompt: System prompt to set behavior
+            token_budget: Estimated tokens of verbatim history allowed before compacting
+            keep_recent: Number of most recent messages never summarized
+            summary_max_tokens: Maximum tokens for the running summary
+        """
         self.claude = claude_wrapper
         self.system_prompt = system_prompt
+        self.token_budget = token_budget
+        self.keep_recent = keep_recent
+        self.summary_max_tokens = summary_max_tokens
+        self.summary = ""
         self.messages: List[Dict[str, str]] = []
+        self.history_tokens = 0  # running estimate for self.messages
     
     def add_message(self, role: str, content: str):
         """Add a message to conversation history"""
         self.messages.append({"role": role, "content": content})
+        self.history_tokens += estimate_tokens(content)
     
     def send_message(self, message: str, **kwargs) -> str:
         """Send message and update conversation history"""
         # Add user message
         self.add_message("user", message)
-        
-        # Get response
-        response = self.claude.chat_with_history(
-            messages=self.messages,
-            system=self.system_prompt,
-            **kwargs
-        )
+        try:
+            self._compact()
+
+            # Get response
+            response = self.claude.chat_with_history(
+                messages=self._request_messages(),
+                system=self._system_blocks(),
+                **kwargs
+            )
+        except Exception:
+            self._drop_unanswered()
+            raise
         
         # Add Claude's response to history
         self.add_message("assistant", response)
         
         return response
+
+    def send_message_with_tools(self,
+                                message: str,
+                                tools: List[Dict],
+                                run_tool: Callable[[str, Dict], Dict],
+                                max_rounds: int = 6,
+                                **kwargs) -> str:
+        """
+        Send message, letting the model call tools until it answers
+
+        Only the question and the final answer go into the history, so
+        follow-ups keep their context without carrying every tool round.
+
+        Args:
+            message: User message
+            tools: Tool definitions (name, description, input_schema)
+            run_tool: Called as run_tool(name, input); returns a JSON-serializable result.
+                ValueError/TypeError are reported back to the model as tool errors
+            max_rounds: Maximum model calls before giving up
+
+        Returns:
+            The final text answer
+        """
+        self.add_message("user", message)
+        try:
+            self._compact()
+            messages = self._request_messages()
+
+            for _ in range(max_rounds):
+                response = self.claude.chat_with_tools(
+                    messages=messages,
+                    tools=tools,
+                    system=self._system_blocks(),
+                    **kwargs
+                )
+                if response.stop_reason != "tool_use":
+                    answer = "".join(block.text for block in response.content if block.type == "text")
+                    self.add_message("assistant", answer)
+                    return answer
+
+                results = []
+                for block in response.content:
+                    if block.type != "tool_use":
+                        continue
+                    try:
+                        content, is_error = json.dumps(run_tool(block.name, block.input)), False
+                    except (ValueError, TypeError) as e:
+                        content, is_error = str(e), True
+                    results.append({"type": "tool_result", "tool_use_id": block.id, "content": content, "is_error": is_error})
+
+                messages.append({"role": "assistant", "content": [block.model_dump(exclude_none=True) for block in response.content]})
+                messages.append({"role": "user", "content": results})
+
+            raise RuntimeError(f"No answer after {max_rounds} tool rounds")
+        except Exception:
+            self._drop_unanswered()
+            raise
+
+    def _drop_unanswered(self):
+        """After a failed turn, leave the history ending on an answered turn"""
+        if self.messages and self.messages[-1]["role"] == "user":
+            self.history_tokens -= estimate_tokens(self.messages.pop()["content"])
+
+    def context_tokens(self) -> int:
+        """Estimated tokens of system prompt, summary and history sent on the next turn"""
+        return estimate_tokens(self._system_blocks() or []) + self.history_tokens
+
+    def _compact(self):
+        """Fold the oldest messages into the summary once over budget"""
+        if self.history_tokens <= self.token_budget:
+            return
+
+        # compact down to half the budget so this doesn't run every turn
+        target = self.token_budget // 2
+        keep = max(self.keep_recent, 1)  # the turn being sent is never summarized
+        cut, remaining = 0, self.history_tokens
+        while len(self.messages) - cut > keep and remaining > target:
+            remaining -= estimate_tokens(self.messages[cut]["content"])
+            cut += 1
+
+        # the verbatim part must still start with a user turn; back up to one
+        # rather than cut into the last keep_recent messages
+        while cut > 0 and self.messages[cut]["role"] != "user":
+            cut -= 1
+        if cut == 0:
+            return
+
+        self.summary = self._summarize(self.messages[:cut])
+        self.messages = self.messages[cut:]
+        self.history_tokens = sum(estimate_tokens(m["content"]) for m in self.messages)
+
+    def _summarize(self, messages: List[Dict[str, str]]) -> str:
+        transcript = "\n".join(f"{m['role']}: {m['content']}" for m in messages)
+        prompt = f"Existing summary:\n{self.summary or '(none)'}\n\nNew turns:\n{transcript}"
+        return self.claude.chat(
+            prompt,
+            max_tokens=self.summary_max_tokens,
+            temperature=0,
+            system=SUMMARY_SYSTEM_PROMPT
+        )
+
+    def _system_blocks(self) -> Optional[List[Dict]]:
+        """System prompt + summary: the stable, cacheable prefix"""
+        blocks = []
+        if self.system_prompt:
+            blocks.append({"type": "text", "text": self.system_prompt})
+        if self.summary:
+            blocks.append({"type": "text", "text": f"Summary of the conversation so far:\n{self.summary}"})
+        if not blocks:
+            return None
+        blocks[-1]["cache_control"] = {"type": "ephemeral"}
+        return blocks
+
+    def _request_messages(self) -> List[Dict]:
+        """History with a cache breakpoint on the latest turn, so the next turn reads it from cache"""
+        messages = self.messages[:-1]
+        last = self.messages[-1]
+        return messages + [{
+            "role": last["role"],
+            "content": [{"type": "text", "text": last["content"], "cache_control": {"type": "ephemeral"}}]
+        }]
     
     def clear_history(self):
         """Clear conversation history"""
         self.messages = []
+        self.summary = ""
+        self.history_tokens = 0
     
     def get_history(self) -> List[Dict[str, str]]:
-        """Get conversation history"""
+        """Get the verbatim (not yet summarized) conversation history"""
         return self.messages.copy()
 
 
@@ -0,0 +1,302 @@
+# multi_receipt.py
+"""
+Receipts that don't fit one image, and images that hold several receipts.
+
+extract_pages reads an ordered list of shots of one long receipt in parallel
+and merges them, dropping the items repeated where consecutive shots overlap.
+detect_regions finds separate receipts in one scan locally (paper-coloured
+blobs), so extract_regions can read each of them, also in parallel. Both
+return the same JSON string / "None" contract as read_receipt, and
+check_totals runs on whatever ends up being stored. Amounts come from the
+model and may be strings ("$3.50", "N/A"), so they go through to_amount.
+"""
+import os, io, re, json, math, base64
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from typing import Dict, List, Optional
+
+from claude_wrapper import ClaudeWrapper
+from receipt_prefilter import Image, ImageFilter, PAPER_MIN_VALUE, paper_mask
+
+MAX_WORKERS         = int(os.environ.get("MULTI_RECEIPT_WORKERS", "4"))
+REGION_GRID         = 128    # long side of the mask regions are found on
+MIN_REGION_SHARE    = 0.04   # of the image area
+MIN_REGION_RELATIVE = 0.25   # of the largest region's area
+MIN_REGION_FILL     = 0.6    # region area / bounding box area; receipts are rectangles
+REGION_PADDING      = 0.02   # of the image size, added around each crop
+TOTALS_TOLERANCE    = 0.02   # dollars
+
+
+def to_amount(value) -> Optional[float]:
+    """A model-reported amount as a float: numbers, or strings like "$3.50" / "1,234.50"; None if unreadable"""
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float, Decimal)):
+        amount = float(value)
+    elif isinstance(value, str):
+        try:
+            amount = float(value.strip().replace("$", "").replace(",", "").replace(" ", ""))
+        except ValueError:
+            return None
+    else:
+        return None
+    return amount if math.isfinite(amount) else None
+
+def vendor_key(vendor) -> Optional[str]:
+    """Vendor name folded for case-insensitive search ("Trader  JOE'S" -> "trader joe's")"""
+    folded = " ".join(str(vendor).casefold().split()) if vendor is not None else ""
+    return folded or None
+
+def parse_result(result_str) -> Optional[Dict]:
+    """read_receipt output as a dict, or None for "None" / unparseable output"""
+    if not result_str or result_str.strip().lower() == "none":
+        return None
+    try:
+        parsed = json.loads(result_str)
+    except json.JSONDecodeError:
+        return None
+    return parsed if isinstance(parsed, dict) else None
+
+def read_parallel(claude: ClaudeWrapper, images: List[str], categories: Optional[list] = [], max_tokens: int = 4096) -> List[str]:
+    """read_receipt for each image concurrently, results in input order"""
+    if len(images) == 1:
+        return [claude.read_receipt(images[0], categories=categories, max_tokens=max_tokens)]
+    with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(images))) as pool:
+        return list(pool.map(lambda b64: claude.read_receipt(b64, categories=categories, max_tokens=max_tokens), images))
+
+
+# ---- multi-page ----
+
+def _item_key(item: Dict) -> tuple:
+    cost, amount = item.get("cost"), to_amount(item.get("cost"))
+    # an unreadable cost still matches the same text on the next shot
+    return (" ".join(str(item.get("name", "")).lower().split()),
+            round(amount, 2) if amount is not None else (str(cost).strip() if cost is not None else None))
+
+def _overlap(previous: List[Dict], items: List[Dict]) -> int:
+    """Longest run of items that both ends `previous` and starts `items`"""
+    prev_keys = [_item_key(i) for i in previous]
+    keys = [_item_key(i) for i in items]
+    for k in range(min(len(prev_keys), len(keys)), 0, -1):
+        if prev_keys[-k:] == keys[:k]:
+            return k
+    return 0
+
+def merge_pages(pages: List[Optional[Dict]]) -> Optional[Dict]:
+    """
+    Merge parsed shots of one receipt, in order.
+
+    Items repeated across the seam between consecutive shots are kept once.
+    Vendor and date come from the first shot that has them; subtotal, taxes,
+    fees and total from the last one (they print at the bottom).
+    """
+    pages = [p for p in pages if p]
+    if not pages:
+        return None
+
+    merged = {"items": []}
+    for page in pages:
+        items = page.get("items", [])
+        merged["items"].extend(items[_overlap(merged["items"], items):])
+        for field in ("vendor", "date", "userId"):
+            if merged.get(field) is None and page.get(field) is not None:
+                merged[field] = page[field]
+        for field in ("subtotal", "taxes", "fees", "total"):
+            if page.get(field) is not None:
+                merged[field] = page[field]
+    return merged
+
+def extract_pages(claude: ClaudeWrapper, images: List[str], categories: Optional[list] = [], max_tokens: int = 4096) -> str:
+    """
+    Read an ordered list of shots of one long receipt.
+
+    Returns:
+        JSON string of the merged receipt, or 'None' if no shot was a receipt
+    """
+    return merge_results(read_parallel(claude, images, categories, max_tokens))
+
+def merge_results(results: List[str]) -> str:
+    """read_receipt outputs for the shots of one receipt, in order, as one result string"""
+    merged = merge_pages([parse_result(r) for r in results])
+    return json.dumps(merged) if merged else "None"
+
+
+# ---- multi-receipt ----
+
+_PAPER_RUN = re.compile(rb"\xff+")
+
+def _components(mask) -> List[tuple]:
+    """
+    (area, (x0, y0, x1, y1)) of each 4-connected white blob. Works on runs of
+    white pixels per row (found by the regex engine) joined with union-find,
+    rather than visiting pixels one by one.
+    """
+    width, height = mask.size
+    px = mask.tobytes()
+    runs, parent = [], []          # (y, x0, x1 exclusive), union-find parent per run
+
+    def root(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    previous = []
+    for y in range(height):
+        current = []
+        for match in _PAPER_RUN.finditer(px, y * width, (y + 1) * width):
+            x0, x1 = match.start() - y * width, match.end() - y * width
+            idx = len(runs)
+            runs.append((y, x0, x1))
+            parent.append(idx)
+            for j in previous:
+                _, px0, px1 = runs[j]
+                if px0 < x1 and x0 < px1:
+                    parent[root(j)] = root(idx)
+            current.append(idx)
+        previous = current
+
+    blobs = {}
+    for i, (y, x0, x1) in enumerate(runs):
+        area, (bx0, by0, bx1, by1) = blobs.get(root(i), (0, (width, height, -1, -1)))
+        blobs[root(i)] = (area + x1 - x0, (min(bx0, x0), min(by0, y), max(bx1, x1 - 1), max(by1, y)))
+    return list(blobs.values())
+
+def _otsu_level(hist: List[int]) -> int:
+    """Brightness cut-off that best splits a histogram into two classes"""
+    total = sum(hist)
+    weighted = sum(i * h for i, h in enumerate(hist))
+    below = below_weighted = 0
+    best, level = -1.0, 0
+    for t, count in enumerate(hist):
+        below += count
+        above = total - below
+        if not below:
+            continue
+        if not above:
+            break
+        below_weighted += t * count
+        spread = below * above * (below_weighted / below - (weighted - below_weighted) / above) ** 2
+        if spread > best:
+            best, level = spread, t + 1
+    return level
+
+def _decode_small(image):
+    if image.format == "JPEG":
+        image.draft("RGB", (REGION_GRID, REGION_GRID))  # let libjpeg decode at reduced scale
+    return image.convert("RGB")
+
+def find_regions(size: tuple, thumbnail) -> List[tuple]:
+    """
+    Bounding boxes of separate receipts, top-to-bottom then left-to-right.
+    Fewer than two boxes means "treat as one receipt".
+
+    Args:
+        size: (width, height) of the full image; boxes are in its pixels
+        thumbnail: Any downscaled RGB rendering of it, e.g. the pre-filter's
+    """
+    width, height = size
+    small = thumbnail.copy()
+    small.thumbnail((REGION_GRID, REGION_GRID))
+
+    # receipts in one scan can differ in brightness, so split paper from the table
+    # by the histogram rather than relative to the brightest receipt
+    level = max(PAPER_MIN_VALUE, _otsu_level(small.convert("HSV").getchannel(2).histogram()))
+    # then close the gaps printed text leaves in the mask
+    mask = paper_mask(small, level).filter(ImageFilter.MedianFilter(3)).filter(ImageFilter.MaxFilter(3))
+    grid_w, grid_h = mask.size
+    components = _components(mask)
+    if not components:
+        return []
+
+    largest = max(area for area, _ in components)
+    regions = []
+    for area, (x0, y0, x1, y1) in components:
+        box_area = (x1 - x0 + 1) * (y1 - y0 + 1)
+        if (area >= MIN_REGION_SHARE * grid_w * grid_h and area >= MIN_REGION_RELATIVE * largest
+                and area / box_area >= MIN_REGION_FILL):
+            regions.append((x0, y0, x1 + 1, y1 + 1))
+
+    sx, sy = width / grid_w, height / grid_h
+    pad_x, pad_y = int(REGION_PADDING * width), int(REGION_PADDING * height)
+    boxes = [(max(int(x0 * sx) - pad_x, 0), max(int(y0 * sy) - pad_y, 0),
+              min(int(x1 * sx) + pad_x, width), min(int(y1 * sy) + pad_y, height))
+             for x0, y0, x1, y1 in regions]
+    return sorted(boxes, key=lambda b: (b[1] // max(height // 4, 1), b[0]))
+
+def detect_regions(base64_input: str, thumbnail=None) -> List[str]:
+    """
+    Split a scan holding several receipts into one base64 JPEG per receipt.
+
+    Args:
+        base64_input: Base64-encoded image, as passed to read_receipt
+        thumbnail: Downscaled RGB copy already decoded (the pre-filter keeps one); saves a decode
+
+    Returns:
+        The crops, or [base64_input] when there is a single receipt (or Pillow is missing)
+    """
+    if Image is None:
+        return [base64_input]
+    try:
+        image = Image.open(io.BytesIO(base64.b64decode(base64_input)))  # reads the header only
+        boxes = find_regions(image.size, thumbnail if thumbnail is not None else _decode_small(image))
+    except Exception:
+        return [base64_input]
+    if len(boxes) < 2:
+        return [base64_input]
+
+    full = Image.open(io.BytesIO(base64.b64decode(base64_input))).convert("RGB")
+    crops = []
+    for box in boxes:
+        buf = io.BytesIO()
+        full.crop(box).save(buf, format="JPEG", quality=90)
+        crops.append(base64.b64encode(buf.getvalue()).decode("utf-8"))
+    return crops
+
+def extract_regions(claude: ClaudeWrapper, base64_input: str, categories: Optional[list] = [], max_tokens: int = 4096,
+                    thumbnail=None) -> List[str]:
+    """
+    Read every receipt in one image (thumbnail as for detect_regions).
+
+    Returns:
+        One read_receipt result (JSON string or 'None') per detected receipt
+    """
+    return read_parallel(claude, detect_regions(base64_input, thumbnail), categories, max_tokens)
+
+
+# ---- checks ----
+
+def check_totals(receipt: Dict) -> List[str]:
+    """
+    Arithmetic problems in a parsed receipt; empty when it adds up.
+    Unreadable amounts are reported, and the checks that need them skipped.
+    """
+    warnings = []
+    unreadable = set()
+
+    def num(field):
+        value = receipt.get(field)
+        amount = to_amount(value)
+        if value is not None and amount is None:
+            warnings.append(f"{field} {value!r} is not an amount")
+            unreadable.add(field)
+        return amount
+
+    items_sum = 0.0
+    for item in receipt.get("items", []):
+        cost = to_amount(item.get("cost") or 0)
+        if cost is None:
+            warnings.append(f"cost of {item.get('name')!r} ({item.get('cost')!r}) is not an amount")
+            unreadable.add("items")
+        else:
+            items_sum += cost
+    subtotal, taxes, fees, total = num("subtotal"), num("taxes"), num("fees"), num("total")
+
+    if (subtotal is not None and receipt.get("items") and "items" not in unreadable
+            and abs(items_sum - subtotal) > TOTALS_TOLERANCE):
+        warnings.append(f"items sum to {items_sum:.2f} but subtotal is {subtotal:.2f}")
+    if subtotal is not None and total is not None and not unreadable & {"taxes", "fees"}:
+        expected = subtotal + (taxes or 0) + (fees or 0)
+        if abs(expected - total) > TOTALS_TOLERANCE:
+            warnings.append(f"subtotal + taxes + fees is {expected:.2f} but total is {total:.2f}")
+    return warnings
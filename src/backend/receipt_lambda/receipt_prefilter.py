@@ -0,0 +1,210 @@
+# receipt_prefilter.py
+"""
+Cheap local checks that run before the vision call.
+
+Works on a small grayscale/HSV thumbnail and rejects images that are clearly
+not receipts (blank or near-blank frames, scenes with no paper-like region,
+no text-like edges or pure noise, extreme aspect ratios) plus repeats of an
+image the same user just uploaded. Everything else goes on to read_receipt.
+
+A repeat is the same file again, or a near-identical image (dHash) within a
+few minutes of the first. dHash alone can't tell two receipts from the same
+store apart, so a near match that arrives later is treated as a new receipt.
+"""
+import os, io, time, base64, hashlib
+from collections import OrderedDict
+from typing import Optional
+
+try:
+    from PIL import Image, ImageChops, ImageFilter, ImageStat
+except ImportError:  # Pillow not bundled -> every image goes to the model
+    Image = None
+
+THUMB_SIZE = 256
+
+# Thresholds (override with PREFILTER_<NAME> env vars)
+BLANK_STD        = float(os.environ.get("PREFILTER_BLANK_STD", "8"))          # gray stddev below this = blank
+MIN_PAPER        = float(os.environ.get("PREFILTER_MIN_PAPER", "0.08"))       # fraction of bright, unsaturated pixels
+MIN_EDGE_DENSITY = float(os.environ.get("PREFILTER_MIN_EDGE_DENSITY", "0.03"))
+MAX_EDGE_DENSITY = float(os.environ.get("PREFILTER_MAX_EDGE_DENSITY", "0.30"))
+MAX_ASPECT       = float(os.environ.get("PREFILTER_MAX_ASPECT", "12"))        # long side / short side
+DUPLICATE_BITS   = int(os.environ.get("PREFILTER_DUPLICATE_BITS", "4"))       # dHash hamming distance
+DUPLICATE_WINDOW = float(os.environ.get("PREFILTER_DUPLICATE_WINDOW", "120")) # seconds a near match counts
+HISTORY_SIZE     = int(os.environ.get("PREFILTER_HISTORY_SIZE", "256"))      # users remembered
+HASHES_PER_USER  = 32
+
+PAPER_MIN_VALUE  = 90    # HSV value (brightness) floor for paper pixels
+PAPER_RELATIVE   = 0.8   # ... and at least this share of the 95th percentile brightness
+PAPER_MAX_SAT    = 70    # HSV saturation for paper pixels
+EDGE_LEVEL       = 40    # edge magnitude counted as an edge pixel
+
+
+class Verdict:
+    """Result of a pre-filter check."""
+
+    def __init__(self, accepted: bool, reason: str = "", features: Optional[dict] = None):
+        self.accepted = accepted
+        self.reason = reason
+        self.features = features or {}
+
+    def __bool__(self):
+        return self.accepted
+
+    def __repr__(self):
+        return f"Verdict(accepted={self.accepted}, reason={self.reason!r})"
+
+
+def _threshold(level: int, invert: bool = False) -> list:
+    # lookup table for Image.point: 255 where value >= level (or < level if inverted)
+    return [255 if (v >= level) != invert else 0 for v in range(256)]
+
+def _percentile(channel, q: float) -> int:
+    hist = channel.histogram()
+    target = q * sum(hist)
+    seen = 0
+    for value, count in enumerate(hist):
+        seen += count
+        if seen >= target:
+            return value
+    return 255
+
+def _fraction(mask) -> float:
+    hist = mask.histogram()
+    return hist[255] / max(sum(hist), 1)
+
+def paper_mask(rgb, paper_level=None):
+    """
+    255 where a pixel looks like receipt paper: bright for this frame and unsaturated.
+    paper_level overrides the brightness cut-off (0-255).
+    """
+    _, sat, val = rgb.convert("HSV").split()
+    if paper_level is None:
+        # paper is judged relative to the brightest part of the frame so dim photos still count
+        paper_level = max(PAPER_MIN_VALUE, int(PAPER_RELATIVE * _percentile(val, 0.95)))
+    bright = val.point(_threshold(paper_level))
+    unsaturated = sat.point(_threshold(PAPER_MAX_SAT + 1, invert=True))
+    return ImageChops.multiply(bright, unsaturated)
+
+def image_features(image) -> dict:
+    """Compute the statistics the pre-filter decides on (plus the RGB thumbnail, for reuse)."""
+    width, height = image.size
+    if image.format == "JPEG":
+        image.draft("RGB", (THUMB_SIZE, THUMB_SIZE))  # let libjpeg decode at reduced scale
+    rgb = image.convert("RGB")
+    rgb.thumbnail((THUMB_SIZE, THUMB_SIZE))
+    gray = rgb.convert("L")
+    edges = gray.filter(ImageFilter.FIND_EDGES).point(_threshold(EDGE_LEVEL))
+
+    return {
+        "aspect": max(width, height) / max(min(width, height), 1),
+        "std": ImageStat.Stat(gray).stddev[0],
+        "paper": _fraction(paper_mask(rgb)),
+        "edge_density": _fraction(edges),
+        "dhash": dhash(gray),
+        "thumbnail": rgb,
+    }
+
+def dhash(gray) -> int:
+    """64-bit difference hash, stable under resizing and recompression."""
+    small = gray.resize((9, 8), Image.BILINEAR)
+    px = list(small.getdata())
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            bits = (bits << 1) | (px[row * 9 + col] > px[row * 9 + col + 1])
+    return bits
+
+
+class ReceiptPrefilter:
+    """In-process non-receipt / duplicate rejection ahead of read_receipt."""
+
+    def __init__(self,
+                 blank_std: float = BLANK_STD,
+                 min_paper: float = MIN_PAPER,
+                 min_edge_density: float = MIN_EDGE_DENSITY,
+                 max_edge_density: float = MAX_EDGE_DENSITY,
+                 max_aspect: float = MAX_ASPECT,
+                 duplicate_bits: int = DUPLICATE_BITS,
+                 duplicate_window: float = DUPLICATE_WINDOW,
+                 history_size: int = HISTORY_SIZE):
+        self.blank_std = blank_std
+        self.min_paper = min_paper
+        self.min_edge_density = min_edge_density
+        self.max_edge_density = max_edge_density
+        self.max_aspect = max_aspect
+        self.duplicate_bits = duplicate_bits
+        self.duplicate_window = duplicate_window
+        self.history_size = history_size
+        self.recent: "OrderedDict[str, list]" = OrderedDict()   # user -> recent (dHash, digest, key, time)
+
+    def check(self, base64_input: str, user: Optional[str] = None, key: Optional[str] = None,
+              now: Optional[float] = None) -> Verdict:
+        """
+        Decide whether an image is worth a vision call.
+
+        Nothing is remembered here: call remember() once the upload has been
+        stored, so a retry after a failed vision call isn't its own duplicate.
+
+        Args:
+            base64_input: Base64-encoded image, as passed to read_receipt
+            user: If given, the image is compared against this user's recent uploads
+            key: Upload key (s3Key); an earlier upload with the same key never counts as a duplicate
+            now: Upload time (epoch seconds), defaults to the current time
+
+        Returns:
+            Verdict; falsy when the image should be rejected
+        """
+        if Image is None:
+            return Verdict(True, "prefilter unavailable")
+
+        try:
+            raw = base64.b64decode(base64_input)
+            features = image_features(Image.open(io.BytesIO(raw)))
+        except Exception:
+            # undecodable input can't be a receipt photo either
+            return Verdict(False, "undecodable")
+        features["digest"] = hashlib.sha1(raw).hexdigest()
+
+        reason = self.classify(features)
+        if reason:
+            return Verdict(False, reason, features)
+
+        if user is not None and self.is_duplicate(user, features, key, now):
+            return Verdict(False, "duplicate", features)
+
+        return Verdict(True, "", features)
+
+    def classify(self, features: dict) -> str:
+        """Return the rejection reason for a feature set, or "" if it may be a receipt."""
+        if features["aspect"] > self.max_aspect:
+            return "aspect"
+        if features["std"] < self.blank_std:
+            return "blank"
+        if features["paper"] < self.min_paper:
+            return "no_paper"
+        if features["edge_density"] < self.min_edge_density:
+            return "no_text"
+        if features["edge_density"] > self.max_edge_density:
+            return "noise"
+        return ""
+
+    def is_duplicate(self, user: str, features: dict, key: Optional[str] = None, now: Optional[float] = None) -> bool:
+        """Same file as a recent upload, or a near-identical image within duplicate_window seconds of one"""
+        now = time.time() if now is None else now
+        for hash_, digest, seen_key, seen_at in self.recent.get(user, []):
+            if key is not None and seen_key == key:
+                continue
+            if digest == features["digest"]:
+                return True
+            if now - seen_at < self.duplicate_window and bin(hash_ ^ features["dhash"]).count("1") <= self.duplicate_bits:
+                return True
+        return False
+
+    def remember(self, user: str, features: dict, key: Optional[str] = None, now: Optional[float] = None):
+        """Add a stored upload (the features of its accepted verdict) to the user's recent uploads"""
+        now = time.time() if now is None else now
+        hashes = [h for h in self.recent.pop(user, []) if key is None or h[2] != key]
+        hashes = (hashes + [(features["dhash"], features["digest"], key, now)])[-HASHES_PER_USER:]
+        self.recent[user] = hashes
+        while len(self.recent) > self.history_size:
+            self.recent.popitem(last=False)
@@ -1,4 +1,4 @@
-import React, { useState } from "react";
+import React, { useEffect, useState } from "react";
 import {
   PlusCircle,
   FileUp,
@@ -11,6 +11,7 @@ import {
 import { Card, CardHeader, CardTitle, CardContent } from "@/components/ui/card";
 import { Button } from "@/components/ui/button";
 import { Input } from "@/components/ui/input";
+import { fetchTransactions } from "@/utils/api";
 
 const BudgetDashboard = () => {
   const [settingsOpen, setSettingsOpen] = useState(false);
@@ -59,6 +60,35 @@ const BudgetDashboard = () => {
     ],
   });
 
+  // first screen: the newest receipts in one small request; older pages load by cursor.
+  // Kept apart from state.transactions, which is the saved state sendStateToBackend persists;
+  // replacing that with one page would save a truncated list.
+  const [recentTransactions, setRecentTransactions] = useState<
+    typeof state.transactions | null
+  >(null);
+
+  const loadRecentTransactions = (userId) =>
+    fetchTransactions({ userId, limit: 25 })
+      .then((page) => {
+        if (page.count > 0) {
+          setRecentTransactions(
+            page.transactions.map(({ name, amount, date, category }) => ({
+              name,
+              amount,
+              date,
+              category: category ?? "",
+            }))
+          );
+        }
+      })
+      .catch(() => {});
+
+  useEffect(() => {
+    loadRecentTransactions(state.user_id);
+  }, [state.user_id]);
+
+  const listedTransactions = recentTransactions ?? state.transactions;
+
   const remaining = state.budget - state.spent;
   const avgDaily = state.spent > 0 ? (state.spent / 30).toFixed(2) : 0;
   const daysLeft = 16;
@@ -83,6 +113,7 @@ const BudgetDashboard = () => {
       const data = await response.json();
       console.log("Backend response:", data);
       setState(data);
+      loadRecentTransactions(updatedState.user_id);
     } catch (error) {
       console.error(error);
     }
@@ -299,13 +330,13 @@ const BudgetDashboard = () => {
             </CardTitle>
           </CardHeader>
           <CardContent>
-            {state.transactions.length === 0 ? (
+            {listedTransactions.length === 0 ? (
               <p className="text-gray-500">
                 No transactions yet. Add your first transaction to get started!
               </p>
             ) : (
               <ul className="space-y-3">
-                {state.transactions.map((tx, idx) => (
+                {listedTransactions.map((tx, idx) => (
                   <li
                     key={idx}
                     className="flex justify-between items-center py-2 border-b last:border-b-0"
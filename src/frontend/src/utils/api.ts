@@ -70,4 +70,53 @@ export const uploadReceiptToServer = async (imageFile: File, transactionData: an
     console.error('Error uploading receipt:', error);
     throw error;
   }
-};
\ No newline at end of file
+};
+
+export interface Transaction {
+  id: string;
+  name: string;
+  amount: number;
+  date: string;
+  category: string | null;
+}
+
+export interface TransactionPage {
+  transactions: Transaction[];
+  next_cursor: string | null;
+  count: number;
+}
+
+export interface TransactionQuery {
+  userId: string;
+  from?: string;      // YYYY-MM-DD, inclusive
+  to?: string;        // YYYY-MM-DD, inclusive
+  category?: string;
+  vendor?: string;
+  limit?: number;
+  cursor?: string;    // next_cursor from the previous page
+  order?: 'desc' | 'asc';
+}
+
+// One page of receipts, newest first. The server sends an ETag, so the
+// browser revalidates and an unchanged page comes back as a cheap 304.
+export const fetchTransactions = async (query: TransactionQuery): Promise<TransactionPage> => {
+  const params = new URLSearchParams({ user_id: query.userId });
+  const optional = { from: query.from, to: query.to, category: query.category, vendor: query.vendor,
+                     limit: query.limit?.toString(), cursor: query.cursor, order: query.order };
+  Object.entries(optional).forEach(([key, value]) => {
+    if (value) params.set(key, value);
+  });
+
+  try {
+    const response = await fetch(`/api/transactions?${params.toString()}`, { cache: 'no-cache' });
+
+    if (!response.ok) {
+      throw new Error(`HTTP error! status: ${response.status}`);
+    }
+
+    return await response.json();
+  } catch (error) {
+    console.error('Error loading transactions:', error);
+    throw error;
+  }
+};
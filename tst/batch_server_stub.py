@@ -0,0 +1,125 @@
+"""
+Local stand-in for the Message Batches API.
+
+Implements just enough of /v1/messages/batches for the anthropic client:
+create, retrieve and the results .jsonl stream. Batches report "in_progress"
+for a few polls before ending, and each request is answered by `responder`.
+"""
+import json
+import threading
+import uuid
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def _iso(dt: datetime) -> str:
+    return dt.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+class StubBatchServer:
+    def __init__(self, responder, polls_until_ended: int = 2, port: int = 0):
+        """
+        Args:
+            responder: Callable(params) -> text, or None to mark the request errored
+            polls_until_ended: Retrieves answered with "in_progress" before "ended"
+            port: Port to bind on localhost (0 picks a free one)
+        """
+        self.responder = responder
+        self.polls_until_ended = polls_until_ended
+        self.batches = {}
+        self.requests_seen = 0
+
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                if self.path.rstrip("/") != "/v1/messages/batches":
+                    return self._send(404, {"type": "error", "error": {"type": "not_found_error", "message": self.path}})
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                self._send(200, stub._create(body["requests"]))
+
+            def do_GET(self):
+                parts = self.path.strip("/").split("/")
+                batch = stub.batches.get(parts[3]) if len(parts) >= 4 else None
+                if batch is None:
+                    return self._send(404, {"type": "error", "error": {"type": "not_found_error", "message": self.path}})
+                if len(parts) == 5 and parts[4] == "results":
+                    return self._send_jsonl(batch["results"])
+                self._send(200, stub._poll(batch))
+
+            def _send(self, status, payload):
+                data = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _send_jsonl(self, lines):
+                data = "".join(json.dumps(line) + "\n" for line in lines).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/binary")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.base_url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def _create(self, requests):
+        batch_id = f"msgbatch_{uuid.uuid4().hex[:24]}"
+        results = []
+        for req in requests:
+            self.requests_seen += 1
+            text = self.responder(req["params"])
+            if text is None:
+                result = {"type": "errored", "error": {"type": "error", "error": {"type": "api_error", "message": "stub error"}}}
+            else:
+                result = {"type": "succeeded", "message": {
+                    "id": f"msg_{uuid.uuid4().hex[:24]}",
+                    "type": "message",
+                    "role": "assistant",
+                    "model": req["params"]["model"],
+                    "content": [{"type": "text", "text": text}],
+                    "stop_reason": "end_turn",
+                    "stop_sequence": None,
+                    "usage": {"input_tokens": 0, "output_tokens": 0},
+                }}
+            results.append({"custom_id": req["custom_id"], "result": result})
+
+        now = datetime.now(timezone.utc)
+        self.batches[batch_id] = {"id": batch_id, "created_at": now, "polls": 0, "results": results}
+        return self._describe(self.batches[batch_id], ended=False)
+
+    def _poll(self, batch):
+        batch["polls"] += 1
+        return self._describe(batch, ended=batch["polls"] > self.polls_until_ended)
+
+    def _describe(self, batch, ended: bool):
+        counts = {"processing": 0, "succeeded": 0, "errored": 0, "canceled": 0, "expired": 0}
+        for line in batch["results"]:
+            counts[line["result"]["type"] if ended else "processing"] += 1
+        return {
+            "id": batch["id"],
+            "type": "message_batch",
+            "processing_status": "ended" if ended else "in_progress",
+            "request_counts": counts,
+            "created_at": _iso(batch["created_at"]),
+            "expires_at": _iso(batch["created_at"] + timedelta(days=1)),
+            "ended_at": _iso(datetime.now(timezone.utc)) if ended else None,
+            "archived_at": None,
+            "cancel_initiated_at": None,
+            "results_url": f"{self.base_url}/v1/messages/batches/{batch['id']}/results" if ended else None,
+        }
@@ -0,0 +1,251 @@
+"""
+Offline benchmark and regression check for the receipt pipeline.
+
+Runs read_receipt, the Lambda handler and update_state against the replay
+Anthropic client and in-memory S3/DynamoDB with a synthetic load, reports
+throughput, p50/p95/p99 latency, peak memory and bytes moved per operation,
+and exits non-zero when a metric regresses past tst/benchmark_baseline.json.
+
+    python tst/benchmark_tst.py [--ops 200] [--update-baseline]
+"""
+import argparse
+import base64
+import contextlib
+import gc
+import io
+import json
+import os
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+from datetime import date, timedelta
+from decimal import Decimal
+
+sys.path.insert(0, "src/backend/receipt_lambda")
+sys.path.insert(0, "src/backend")
+os.environ.setdefault("RECEIPTS_TABLE", "receipts")
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ.setdefault("ANTHROPIC_API_KEY", "replay")
+
+from PIL import Image
+
+from fakes import FakeDynamoDB, FakeS3, FakeTable, ReplayAnthropic
+
+import app
+import main
+from claude_wrapper import ClaudeWrapper
+
+BASELINE_PATH = "tst/benchmark_baseline.json"
+BUCKET = "hackcmu-2025"
+
+# allowed growth over the baseline before a metric counts as a regression
+TOLERANCE = {
+    "p95_ms": 1.0,          # timings vary across machines; flag doubling
+    "peak_kb": 0.25,
+    "bytes_per_op": 0.05,
+}
+
+
+# ---- synthetic load ----
+
+def photo_payloads():
+    payloads = []
+    for name in sorted(os.listdir("tst/receipt_photos")):
+        with open(os.path.join("tst/receipt_photos", name), "rb") as f:
+            payloads.append(base64.b64encode(f.read()).decode("utf-8"))
+    return payloads
+
+def blank_payload():
+    buf = io.BytesIO()
+    Image.new("RGB", (900, 1200), "white").save(buf, format="JPEG")
+    return base64.b64encode(buf.getvalue()).decode("utf-8")
+
+def synthetic_uploads(s3, n, seed=0, blank_share=0.1):
+    """Put n receipt uploads (data URLs, like the app sends) into S3; return their Lambda events"""
+    rng = random.Random(seed)
+    photos, blank = photo_payloads(), blank_payload()
+    events = []
+    for i in range(n):
+        body = blank if rng.random() < blank_share else rng.choice(photos)
+        key = f"receipts/uploads/user{i:05d}/receipt_{i}.txt"
+        s3.put_object(Bucket=BUCKET, Key=key, Body="data:image/jpeg;base64," + body)
+        events.append({"Records": [{"s3": {"bucket": {"name": BUCKET}, "object": {"key": key}}}]})
+    return events
+
+def synthetic_states(n, seed=0, max_transactions=500):
+    """Frontend state payloads with a growing transaction list"""
+    rng = random.Random(seed)
+    categories = ["Food & Dining", "Transportation", "Entertainment", "Utilities", "Shopping"]
+    states = []
+    for i in range(n):
+        transactions = [{"name": f"Vendor {rng.randrange(50)}", "amount": rng.randrange(100, 20000) / 100,
+                         "date": f"2025-{rng.randrange(1, 13):02d}-{rng.randrange(1, 29):02d}",
+                         "category": rng.choice(categories)}
+                        for _ in range(rng.randrange(1, max_transactions))]
+        states.append({"user_id": f"user{i % 20}", "string_encoding": "",
+                       "state": {"budget": 3000, "transactions": transactions, "receipt": "",
+                                 "categories": [{"name": c, "limit": 500, "spent": 0} for c in categories]}})
+    return states
+
+def synthetic_receipts(users, days, seed=0):
+    """Receipt rows as the Lambda stores them, one a day per user"""
+    rng = random.Random(seed)
+    categories = ["Food & Dining", "Transportation", "Entertainment", "Utilities", "Shopping"]
+    start = date(2023, 1, 1)
+    return [{"userId": f"user{u}", "date": (start + timedelta(days=d)).isoformat(), "status": "parsed",
+             "vendor": f"Vendor {rng.randrange(50)}", "category": rng.choice(categories),
+             "items": [{"name": f"item {i}", "cost": Decimal(rng.randrange(100, 2000)) / 100} for i in range(8)],
+             "total": Decimal(rng.randrange(100, 20000)) / 100}
+            for u in range(users) for d in range(days)]
+
+
+# ---- measurement ----
+
+def measure(fn, ops, bytes_moved, warmup=None, memory_ops=None):
+    """
+    Latency/throughput pass over ops, then a separate tracemalloc pass (it slows
+    everything down) over memory_ops for peak memory
+    """
+    memory_ops = memory_ops or ops[:max(len(ops) // 10, 5)]
+    with contextlib.redirect_stdout(io.StringIO()):
+        fn(warmup if warmup is not None else ops[0])  # warm up imports and caches
+
+        before = bytes_moved()
+        latencies = []
+        start = time.perf_counter()
+        for op in ops:
+            t = time.perf_counter()
+            fn(op)
+            latencies.append((time.perf_counter() - t) * 1000)
+        wall = time.perf_counter() - start
+        moved = bytes_moved() - before
+
+        gc.collect()
+        tracemalloc.start()
+        for op in memory_ops:
+            fn(op)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    cuts = statistics.quantiles(latencies, n=100)
+    return {
+        "ops": len(ops),
+        "throughput_ops_s": round(len(ops) / wall, 1),
+        "p50_ms": round(cuts[49], 3),
+        "p95_ms": round(cuts[94], 3),
+        "p99_ms": round(cuts[98], 3),
+        "peak_kb": round(peak / 1024, 1),
+        "bytes_per_op": round(moved / len(ops)),
+    }
+
+def bench_read_receipt(n):
+    replay = ReplayAnthropic.seeded()
+    claude = ClaudeWrapper()
+    claude.client = replay
+    payloads = photo_payloads()
+    ops = [payloads[i % len(payloads)] for i in range(n)]
+    return measure(lambda b64: claude.read_receipt(b64, max_tokens=app.MAX_TOKENS), ops,
+                   lambda: replay.bytes_sent + replay.bytes_received)
+
+def bench_handler(n):
+    replay = ReplayAnthropic.seeded()
+    claude = ClaudeWrapper()
+    claude.client = replay
+    s3, table = FakeS3(), FakeTable()
+    # every event is a fresh upload, so none is rejected as a duplicate
+    events = synthetic_uploads(s3, n + 1 + max(n // 10, 5))
+
+    app.s3, app.ddb, app.ClaudeWrapper = s3, table, lambda: claude
+    app.prefilter = app.ReceiptPrefilter()
+    return measure(lambda event: app.handler(event, None), events[1:n + 1],
+                   lambda: s3.bytes_read + table.bytes_written + replay.bytes_sent + replay.bytes_received,
+                   warmup=events[0], memory_ops=events[n + 1:])
+
+def bench_update_state(n):
+    s3, dynamodb = FakeS3(), FakeDynamoDB(schemas={main.STATE_TABLE_NAME: ("user_id", "stateId")})
+    main.s3, main.dynamodb = s3, dynamodb
+    payloads = [json.dumps(state) for state in synthetic_states(n)]
+    moved = {"http": 0}
+
+    def call(body):
+        # the view itself, not the routing, is what's measured
+        with main.app.test_request_context("/api/update-state", method="POST", data=body, content_type="application/json"):
+            response = main.app.make_response(main.update_state())
+        assert response.status_code == 200, response.get_data(as_text=True)[:200]
+        assert response.get_json()["transactions"] == json.loads(body)["state"]["transactions"]
+        moved["http"] += len(body) + len(response.get_data())
+
+    result = measure(call, payloads,
+                     lambda: moved["http"] + s3.bytes_written + dynamodb.Table(main.STATE_TABLE_NAME).bytes_written)
+    # the states carry no string encoding, so nothing may land in S3 for the receipt Lambda to pick up
+    assert not s3.objects, sorted(s3.objects)[:3]
+    return result
+
+def bench_transactions(n):
+    """Dashboard first screen: newest page per user, every other call revalidating its ETag"""
+    dynamodb = FakeDynamoDB()
+    main.dynamodb = dynamodb
+    table = dynamodb.Table(main.TABLE_NAME)
+    for row in synthetic_receipts(users=4, days=2 * 365):
+        table.put_item(Item=row)
+    client = main.app.test_client()
+    etags, moved = {}, {"http": 0}
+
+    def call(user):
+        headers = {"Accept-Encoding": "gzip"}
+        if user in etags:
+            headers["If-None-Match"] = etags.pop(user)
+        response = client.get("/api/transactions", query_string={"user_id": user}, headers=headers)
+        assert response.status_code in (200, 304), response.status_code
+        if response.status_code == 200:
+            etags[user] = response.headers["ETag"]
+        moved["http"] += len(response.get_data())
+
+    return measure(call, [f"user{i % 4}" for i in range(n)], lambda: moved["http"] + table.bytes_read)
+
+BENCHMARKS = {
+    "read_receipt": bench_read_receipt,
+    "handler": bench_handler,
+    "update_state": bench_update_state,
+    "transactions": bench_transactions,
+}
+
+
+def regressions(results, baseline):
+    found = []
+    for name, metrics in results.items():
+        for metric, tolerance in TOLERANCE.items():
+            base = baseline.get(name, {}).get(metric)
+            if base and metrics[metric] > base * (1 + tolerance):
+                found.append(f"{name}.{metric}: {metrics[metric]} > {base} (+{tolerance:.0%} allowed)")
+    return found
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ops", type=int, default=200)
+    parser.add_argument("--update-baseline", action="store_true")
+    args = parser.parse_args()
+
+    results = {}
+    for name, bench in BENCHMARKS.items():
+        results[name] = bench(args.ops)
+        print(f"{name:14} " + " ".join(f"{k}={v}" for k, v in results[name].items()))
+
+    if args.update_baseline:
+        with open(BASELINE_PATH, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"baseline written to {BASELINE_PATH}")
+        sys.exit(0)
+
+    baseline = {}
+    if os.path.exists(BASELINE_PATH):
+        with open(BASELINE_PATH, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+
+    found = regressions(results, baseline)
+    for line in found:
+        print(f"REGRESSION {line}")
+    sys.exit(1 if found else 0)
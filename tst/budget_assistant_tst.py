@@ -0,0 +1,144 @@
+import json
+import random
+import sys
+from decimal import Decimal
+
+sys.path.insert(0, "src/backend/receipt_lambda")
+sys.path.insert(0, "src/backend")
+
+from anthropic.types import Message, TextBlock, ToolUseBlock, Usage
+
+from fakes import FakeDynamoDB
+
+import main
+from budget_assistant import BudgetAssistant, TransactionIndex, from_cents, load_user_index
+
+
+def message(content, stop_reason):
+    return Message(id="msg_tst", type="message", role="assistant", model="stub", content=content,
+                   stop_reason=stop_reason, stop_sequence=None, usage=Usage(input_tokens=0, output_tokens=0))
+
+
+class ScriptedClaude:
+    """Calls sum_spend once per question, then answers with whatever the tool returned."""
+
+    def __init__(self, tool_input):
+        self.tool_input = tool_input
+        self.prompt_sizes = []
+        self.requests = []
+
+    def chat_with_tools(self, messages, tools, system=None, **kwargs):
+        self.prompt_sizes.append(len(json.dumps(messages)) + len(json.dumps(system)))
+        self.requests.append(list(messages))
+        if messages[-1]["content"][0]["type"] != "tool_result":
+            return message([ToolUseBlock(id="toolu_1", type="tool_use", name="sum_spend", input=self.tool_input)], "tool_use")
+        result = json.loads(messages[-1]["content"][0]["content"])
+        return message([TextBlock(type="text", text=f"You spent ${result['total']:.2f}.")], "end_turn")
+
+
+def receipts():
+    rows = []
+    for n in range(1, 5):
+        with open(f"tst/claude_tst_outputs/picture_{n}_output.json", "r", encoding="utf-8") as f:
+            rows.append({"status": "parsed", **json.load(f)})
+    return rows
+
+
+if __name__ == "__main__":
+    # exact totals from the recorded receipts: items + taxes/fees add up to each receipt total
+    index = TransactionIndex.from_receipts(receipts())
+    for row in receipts():
+        got = from_cents(index.sum_spend(start=row["date"], end=row["date"]))
+        print(f"{row['vendor']:32} {row['date']} total={row['total']} indexed={got}")
+        assert abs(got - row["total"]) < 0.011
+    print(f"top vendors: {index.top_vendors(2)}")
+
+    # amounts the model wrote as text don't break indexing
+    odd = {"status": "parsed", "date": "2025-10-01", "vendor": "Cafe", "taxes": "N/A", "fees": "$0.50",
+           "items": [{"name": "Tea", "cost": "$4.00"}, {"name": "Mug", "cost": "N/A"}]}
+    assert TransactionIndex.from_receipts([odd]).sum_spend() == 450
+
+    # frontend-style transactions over several years
+    rng = random.Random(0)
+    categories = ["Food & Dining", "Transportation", "Entertainment", "Utilities", "Shopping"]
+    transactions = [{"name": f"Vendor {rng.randrange(40)}", "amount": rng.randrange(100, 20000) / 100,
+                     "date": f"{rng.randrange(2021, 2026)}-{rng.randrange(1, 13):02d}-{rng.randrange(1, 29):02d}",
+                     "category": rng.choice(categories)} for _ in range(20000)]
+    big = TransactionIndex.from_transactions(transactions)
+    expected = sum(round(t["amount"] * 100) for t in transactions
+                   if t["category"] == "Food & Dining" and "2025-08-01" <= t["date"] <= "2025-08-31")
+    assert big.sum_spend("food & dining", "2025-08-01", "2025-08-31") == expected
+
+    question = "How much did I spend on dining last month?"
+    tool_input = {"category": "Food & Dining", "start_date": "2025-08-01", "end_date": "2025-08-31"}
+
+    small_claude = ScriptedClaude(tool_input)
+    small = TransactionIndex.from_transactions(transactions[:10])
+    BudgetAssistant(small_claude, small, today="2025-09-14").ask(question)
+
+    claude = ScriptedClaude(tool_input)
+    assistant = BudgetAssistant(claude, big, today="2025-09-14")
+    answer = assistant.ask(question)
+    print(f"answer: {answer}")
+    assert answer == f"You spent ${expected / 100:.2f}."
+
+    # prompt size doesn't depend on how many transactions are indexed
+    print(f"prompt chars with 10 vs {len(transactions)} transactions: {small_claude.prompt_sizes} vs {claude.prompt_sizes}")
+    assert all(abs(a - b) < 50 for a, b in zip(claude.prompt_sizes, small_claude.prompt_sizes))
+
+    # a follow-up is sent with the earlier question and answer, but not their tool rounds
+    claude.tool_input = dict(tool_input, start_date="2025-07-01", end_date="2025-07-31")
+    follow_up = assistant.ask("And the month before?")
+    july = sum(round(t["amount"] * 100) for t in transactions
+               if t["category"] == "Food & Dining" and "2025-07-01" <= t["date"] <= "2025-07-31")
+    sent = claude.requests[2]
+    print(f"follow-up: {follow_up} ({len(sent)} messages sent)")
+    assert follow_up == f"You spent ${july / 100:.2f}."
+    assert [m["role"] for m in sent] == ["user", "assistant", "user"]
+    assert sent[0]["content"] == question and sent[1]["content"] == answer
+    assert len(assistant.conversation.get_history()) == 4
+
+    # a failed question leaves the history as it was
+    def overloaded(**kwargs):
+        raise RuntimeError("overloaded")
+    claude.chat_with_tools = overloaded
+    try:
+        assistant.ask("What about August?")
+        raise AssertionError("should have raised")
+    except RuntimeError:
+        pass
+    assert len(assistant.conversation.get_history()) == 4
+
+    # ---- POST /api/ask: questions from the same user continue one conversation ----
+    dynamodb = FakeDynamoDB()
+    main.dynamodb = dynamodb
+    for row in receipts():
+        dynamodb.Table(main.TABLE_NAME).put_item(Item=json.loads(json.dumps({"userId": "shluck", **row}), parse_float=Decimal))
+    day = receipts()[0]["date"]
+    clients = []
+
+    def new_claude():
+        clients.append(ScriptedClaude({"start_date": day, "end_date": day}))
+        return clients[-1]
+    main.ClaudeWrapper = new_claude
+    client = main.app.test_client()
+
+    first = client.post("/api/ask", json={"user_id": "shluck", "question": "What did I spend that day?"})
+    again = client.post("/api/ask", json={"user_id": "shluck", "question": "And overall that day?"})
+    fresh = client.post("/api/ask", json={"user_id": "shluck", "question": "Hi", "new_conversation": True})
+    print(f"/api/ask: {first.get_json()} then {again.get_json()}")
+    assert first.get_json()["answer"] == f"You spent ${receipts()[0]['total']:.2f}."
+    assert len(clients) == 2 and len(clients[0].requests[-1]) == 5 and len(clients[1].requests[-1]) == 3
+    assert fresh.status_code == 200
+    assert client.post("/api/ask", json={"user_id": "shluck"}).status_code == 400
+
+    # a follow-up only reads the receipts stored since the last question
+    table = dynamodb.Table(main.TABLE_NAME)
+    table.put_item(Item=json.loads(json.dumps({"userId": "shluck", **odd, "date": "2099-01-01"}), parse_float=Decimal))
+    before = table.bytes_read
+    load_user_index(table, "shluck")
+    full_read, before = table.bytes_read - before, table.bytes_read
+    assert client.post("/api/ask", json={"user_id": "shluck", "question": "And in 2099?"}).status_code == 200
+    assert main.assistants["shluck"].index.sum_spend(start="2099-01-01") == 450
+    assert 0 < table.bytes_read - before < full_read / 2
+    print("✅ budget assistant")
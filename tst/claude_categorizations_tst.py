@@ -0,0 +1,302 @@
+import base64
+import json
+import os
+import sys
+
+import anthropic
+
+sys.path.insert(0, "src/backend/receipt_lambda")
+sys.path.insert(0, "src/backend")
+os.environ.setdefault("RECEIPTS_TABLE", "receipts")
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ.setdefault("ANTHROPIC_API_KEY", "replay")
+
+from fakes import FakeS3, FakeTable, ReplayAnthropic
+
+import app
+import main
+from categorizer import Categorizer, CategoryIndex, load_corrections, load_index, normalize_name, save_correction, save_index
+from claude_wrapper import ClaudeWrapper
+
+
+CATEGORIES = ["Food & Dining", "Transportation", "Entertainment", "Utilities", "Shopping"]
+
+# past extractions / corrections the index learns from: (vendor, item name, category)
+HISTORY = [
+    ("Starbucks", "Coffee", "Food & Dining"),
+    ("Starbucks", "Iced Coffee Grande", "Food & Dining"),
+    ("Starbucks", "Chai Latte", "Food & Dining"),
+    ("Pizza Hut", "Pepperoni Pizza Large", "Food & Dining"),
+    ("Pizza Hut", "Cheese Pizza", "Food & Dining"),
+    ("Thai Basil", "Pad Thai Tofu", "Food & Dining"),
+    ("Thai Basil", "Chicken Fried Rice", "Food & Dining"),
+    ("Thai Basil", "Yellow Curry Chicken", "Food & Dining"),
+    ("Thai Basil", "Thai Iced Tea", "Food & Dining"),
+    ("Pho 99", "Pho Rice Noodle Beef", "Food & Dining"),
+    ("Chipotle", "Chicken Burrito Bowl", "Food & Dining"),
+    ("Chipotle", "Fountain Soda", "Food & Dining"),
+    ("Whole Foods", "Organic Firm Tofu", "Food & Dining"),
+    ("Whole Foods", "Red Seedless Grapes", "Food & Dining"),
+    ("Whole Foods", "Greek Yogurt Plain 32 oz", "Food & Dining"),
+    ("Whole Foods", "Cheddar Cheese Block", "Food & Dining"),
+    ("Safeway", "Tortilla Chips", "Food & Dining"),
+    ("Safeway", "Teriyaki Sauce", "Food & Dining"),
+    ("Safeway", "Cheese Puffs", "Food & Dining"),
+    ("Safeway", "Strawberry Banana Smoothie", "Food & Dining"),
+    ("Safeway", "Shampoo", "Shopping"),
+    ("Target", "Cotton T Shirt", "Shopping"),
+    ("Target", "Phone Charger USB C", "Shopping"),
+    ("Target", "Paper Towels 6 Pack", "Shopping"),
+    ("Shell", "Gas Regular Unleaded", "Transportation"),
+    ("Shell", "Car Wash", "Transportation"),
+    ("Uber", "Uber Trip", "Transportation"),
+    ("City Parking", "Parking Garage", "Transportation"),
+    ("AMC", "Movie Ticket Adult", "Entertainment"),
+    ("AMC", "Popcorn Large", "Entertainment"),
+    ("Netflix", "Netflix Subscription", "Entertainment"),
+    ("PG&E", "Electric Bill", "Utilities"),
+    ("City Water", "Water Bill", "Utilities"),
+    ("Comcast", "Internet Service", "Utilities"),
+]
+
+# hand labels for the items in tst/claude_tst_outputs (recorded with no categories, so all "Other")
+LABELS = {
+    "Virgin Mai Tai": "Food & Dining",
+    "Kalua Pork Pizza": "Food & Dining",
+    "Margherita Pizza": "Food & Dining",
+    "Wild Mushroom Pizza": "Food & Dining",
+    "Saimin": "Food & Dining",
+    "Tofu Fried Rice": "Food & Dining",
+    "Red Curry Tofu": "Food & Dining",
+    "Vietnamese Rice Noodle Chicken": "Food & Dining",
+    "Chicken Fried Rice": "Food & Dining",
+    "Green Curry Chicken": "Food & Dining",
+    "Italian Soda": "Food & Dining",
+    "Iced Coffee": "Food & Dining",
+    "Extra Rice": "Food & Dining",
+    "Whole Cheese": "Food & Dining",
+    "Whole Pepperoni": "Food & Dining",
+    "World's Puffiest White Cheddar Corn Puffs": "Food & Dining",
+    "Grapes Green Seedless": "Food & Dining",
+    "Greek Yogurt Strawberry Banana 6 Pack": "Food & Dining",
+    "Soy Sauce Reduced Sodium": "Food & Dining",
+    "Granola Clusters Maple Pecan": "Food & Dining",
+    "Spicy Red Chili Pepper Oil": "Food & Dining",
+    "Tofu Firm Organic 14 oz": "Food & Dining",
+}
+
+# receipts outside food so accuracy isn't measured on one category
+EXTRA_RECEIPTS = [
+    {"vendor": "Chevron", "items": [{"name": "Gas Premium Unleaded", "cost": 52.10}, {"name": "Car Wash Deluxe", "cost": 12.00}]},
+    {"vendor": "Walgreens", "items": [{"name": "Shampoo Moisturizing", "cost": 6.49}, {"name": "Phone Case", "cost": 19.99},
+                                      {"name": "Paper Towels", "cost": 8.99}]},
+    {"vendor": "Regal", "items": [{"name": "Movie Ticket Child", "cost": 11.50}, {"name": "Popcorn Small", "cost": 7.00}]},
+]
+LABELS.update({
+    "Gas Premium Unleaded": "Transportation",
+    "Car Wash Deluxe": "Transportation",
+    "Shampoo Moisturizing": "Shopping",
+    "Phone Case": "Shopping",
+    "Paper Towels": "Shopping",
+    "Movie Ticket Child": "Entertainment",
+    "Popcorn Small": "Entertainment",
+})
+
+
+class LabelledClaude:
+    """Offline stand-in answering the batched categorization prompt from LABELS."""
+
+    def __init__(self):
+        self.calls = 0
+        self.items_asked = 0
+
+    def chat(self, message, **kwargs):
+        self.calls += 1
+        lines = [line.split(". ", 1) for line in message.splitlines() if line[:1].isdigit()]
+        self.items_asked += len(lines)
+        return json.dumps({number: LABELS.get(name, "Other") for number, name in lines})
+
+
+class Overloaded(anthropic.APIError):
+    def __init__(self):
+        Exception.__init__(self, "overloaded")
+
+
+class RateLimitedClaude:
+    def chat(self, message, **kwargs):
+        raise Overloaded()
+
+
+class PromptRecorder(ReplayAnthropic):
+    """Replays receipt reads and keeps the text prompt sent with each image."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prompts = []
+
+    def create(self, **kwargs):
+        self.prompts.append(kwargs["messages"][0]["content"][-1]["text"])
+        return super().create(**kwargs)
+
+
+class RacingS3(FakeS3):
+    """Runs `race` (another writer) once, between a writer's read and its put"""
+    race = None
+
+    def put_object(self, **kwargs):
+        race, self.race = self.race, None
+        if race:
+            race()
+        return super().put_object(**kwargs)
+
+
+def upload(s3, key, photo):
+    with open(photo, "rb") as f:
+        s3.put_object(Bucket="b", Key=key, Body=base64.b64encode(f.read()).decode("utf-8"))
+    return {"Records": [{"s3": {"bucket": {"name": "b"}, "object": {"key": key}}}]}
+
+
+def recorded_receipts():
+    receipts = []
+    for n in range(1, 5):
+        with open(f"tst/claude_tst_outputs/picture_{n}_output.json", "r", encoding="utf-8") as f:
+            receipts.append(json.load(f))
+    return receipts
+
+
+def build_index():
+    index = CategoryIndex()
+    for vendor, name, category in HISTORY:
+        index.learn(name, category, vendor)
+    return index
+
+
+def run(categorizer, receipts):
+    """Categorize every receipt; return (local hits, local correct, total, correct)"""
+    hits = hits_correct = total = correct = 0
+    for receipt in receipts:
+        items = [{"name": item["name"], "cost": item["cost"]} for item in receipt["items"]]
+        before = {i: categorizer.index.match(item["name"], CATEGORIES + ["Other"], receipt["vendor"]) for i, item in enumerate(items)}
+        categorizer.categorize(items, CATEGORIES, vendor=receipt["vendor"])
+
+        for i, item in enumerate(items):
+            category, confidence = before[i]
+            is_correct = item["category"] == LABELS[item["name"]]
+            total += 1
+            correct += is_correct
+            if category and confidence >= categorizer.threshold:
+                hits += 1
+                hits_correct += is_correct
+    return hits, hits_correct, total, correct
+
+
+if __name__ == "__main__":
+    assert normalize_name("Tofu Firm Organic 14 oz") == "tofu firm organic"
+    assert normalize_name("Greek Yogurt Strawberry Banana 6 Pack") == "greek yogurt strawberry banana"
+
+    claude = LabelledClaude()
+    categorizer = Categorizer(claude, build_index())
+    receipts = recorded_receipts() + EXTRA_RECEIPTS
+
+    hits, hits_correct, total, correct = run(categorizer, receipts)
+    print(f"first pass:  hit rate={hits / total:.2f} ({hits}/{total}) local accuracy={hits_correct / max(hits, 1):.2f} "
+          f"overall accuracy={correct / total:.2f} model calls={claude.calls} items sent={claude.items_asked}")
+    assert claude.calls <= len(receipts), "ambiguous items go in at most one call per receipt"
+    assert hits / total >= 0.5
+    assert hits_correct == hits
+    assert correct == total
+
+    # the model's answers are learned, so the same receipts resolve locally next time
+    calls_before = claude.calls
+    hits, hits_correct, total, correct = run(categorizer, receipts)
+    print(f"second pass: hit rate={hits / total:.2f} ({hits}/{total}) local accuracy={hits_correct / max(hits, 1):.2f} "
+          f"model calls={claude.calls - calls_before}")
+    assert hits == total and claude.calls == calls_before
+
+    # a user correction wins over learned statistics, and survives a save/load round trip
+    categorizer.index.correct("Italian Soda", "Entertainment")
+    restored = CategoryIndex.from_dict(json.loads(json.dumps(categorizer.index.to_dict())))
+    assert restored.match("Italian Soda", CATEGORIES) == ("Entertainment", 1.0)
+    assert restored.match("Iced Coffee", CATEGORIES, "Square Lotus")[0] == "Food & Dining"
+
+    # an API error while asking falls back to the extracted category (if allowed), else "Other"
+    items = [{"name": "Mystery Gadget", "category": "Shopping"}, {"name": "Unknown Thing", "category": "Gizmos"},
+             {"name": "Coffee"}]
+    counts = Categorizer(RateLimitedClaude(), build_index()).categorize(items, CATEGORIES, vendor="Starbucks")
+    print(f"after an API error: {[(i['name'], i['category']) for i in items]} {counts}")
+    assert [i["category"] for i in items] == ["Shopping", "Other", "Food & Dining"]
+    assert counts == {"local": 1, "model": 0, "pending": 0}
+
+    # a reply wrapped in a code fence still parses
+    fenced = '```json\n{"1": "Shopping", "2": "Food & Dining"}\n```'
+    assert Categorizer.parse_answers(fenced, ["Phone Case", "Bagel"], CATEGORIES) == \
+        {"Phone Case": "Shopping", "Bagel": "Food & Dining"}
+    assert "code fences" in Categorizer.prompt(["Bagel"], CATEGORIES)
+
+    # ---- handler: with categories configured the vision call only reads the receipt ----
+    replay = PromptRecorder(ReplayAnthropic.seeded().recordings)
+    claude = ClaudeWrapper()
+    claude.client = replay
+    claude.chat = LabelledClaude().chat
+    s3, table = FakeS3(), FakeTable()
+    app.s3, app.ddb, app.ClaudeWrapper = s3, table, lambda: claude
+    app.CATEGORIES, app.category_index = CATEGORIES, build_index()
+
+    app.handler(upload(s3, "receipts/uploads/shluck/p1.txt", "tst/receipt_photos/picture_1.jpeg"), None)
+
+    row = next(iter(table.items.values()))
+    print(f"handler: {len(replay.prompts)} vision call(s), categories {sorted({i['category'] for i in row['items']})}")
+    assert replay.prompts and all("categor" not in prompt.lower() for prompt in replay.prompts)
+    assert all(item["category"] == LABELS[item["name"]] for item in row["items"])
+
+    # ---- the index is shared through S3: API corrections reach the Lambda, learning survives a cold start ----
+    uri = "s3://b/category-index/"
+    app.CATEGORY_INDEX_S3 = main.CATEGORY_INDEX_S3 = uri
+    main.s3 = s3
+    client = main.app.test_client()
+    assert client.post("/api/categories/correct", json={"name": "Virgin Mai Tai", "category": "Entertainment"}).status_code == 200
+    assert client.post("/api/categories/correct", json={"name": "14 oz", "category": "Shopping"}).status_code == 400
+
+    app.handler(upload(s3, "receipts/uploads/shluck/p1.txt", "tst/receipt_photos/picture_1.jpeg"), None)
+    row = next(iter(table.items.values()))
+    assert next(i for i in row["items"] if i["name"] == "Virgin Mai Tai")["category"] == "Entertainment"
+
+    cold = load_index(s3, uri)
+    print(f"persisted index: {cold.observations} observations, corrections {cold.corrections}")
+    assert cold.observations == app.category_index.observations
+    assert cold.match("Virgin Mai Tai", CATEGORIES) == ("Entertainment", 1.0)
+
+    # without local categorization, the categories from the vision call are learned and saved
+    app.CATEGORIES = []
+    with open("tst/claude_tst_outputs/picture_2_output.json", "r", encoding="utf-8") as f:
+        labelled = json.load(f)
+    for item in labelled["items"]:
+        item["category"] = LABELS[item["name"]]
+    with open("tst/receipt_photos/picture_2.jpeg", "rb") as f:
+        picture_2 = base64.b64encode(f.read()).decode("utf-8")
+    replay.recordings[ReplayAnthropic.request_key(messages=[{"role": "user", "content": [
+        {"type": "image", "source": {"data": picture_2}}]}])] = json.dumps(labelled)
+    app.handler(upload(s3, "receipts/uploads/shluck/p2.txt", "tst/receipt_photos/picture_2.jpeg"), None)
+    assert normalize_name("Vietnamese Rice Noodle Chicken") in load_index(s3, uri).names
+
+    # concurrent writers: a write that lost the race re-reads and adds its change to the winner's
+    racing, shared = RacingS3(), "s3://b/shared/"
+    first, second = load_index(racing, shared), load_index(racing, shared)
+    first.learn("Oat Milk Latte", "Food & Dining")
+    second.learn("Phone Charger", "Shopping")
+    racing.race = lambda: save_index(racing, shared, first)
+    save_index(racing, shared, second)
+    second.learn("Phone Charger", "Shopping")
+    racing.race = lambda: save_index(racing, shared, first)   # nothing new from first: a no-op merge
+    save_index(racing, shared, second)
+    stored = load_index(racing, shared)
+    print(f"after racing saves: {dict(stored.names)}")
+    assert stored.names["oat milk latte"] == {"Food & Dining": 1}
+    assert stored.names["phone charger"] == {"Shopping": 2}
+    assert not first.unsaved and not second.unsaved
+
+    racing.race = lambda: save_correction(racing, shared, "Oat Milk Latte", "Entertainment")
+    save_correction(racing, shared, "Phone Charger", "Utilities")
+    assert {k: c["category"] for k, c in load_corrections(racing, shared).items()} == \
+        {"oat milk latte": "Entertainment", "phone charger": "Utilities"}
+    print("✅ category index persisted and corrected")
@@ -0,0 +1,64 @@
+import sys
+
+sys.path.insert(0, "src/backend/receipt_lambda")
+
+from claude_wrapper import ConversationManager, estimate_tokens
+
+
+class RecordingClaude:
+    """Offline stand-in for ClaudeWrapper that records what each turn sends."""
+
+    def __init__(self):
+        self.sent_tokens = []
+        self.summaries = 0
+
+    def chat_with_history(self, messages, system=None, **kwargs):
+        self.sent_tokens.append(estimate_tokens(system or []) + sum(estimate_tokens(m["content"]) for m in messages))
+        assert messages[0]["role"] == "user"
+        assert messages[-1]["content"][0]["cache_control"] == {"type": "ephemeral"}
+        return "You spent $85.50 on groceries this week, which is within your Food & Dining limit. " * 6
+
+    def chat(self, message, **kwargs):
+        self.summaries += 1
+        return "User is reviewing weekly spending; groceries $85.50, gas $45.00, within limits. " * 3
+
+
+if __name__ == "__main__":
+    claude = RecordingClaude()
+    conversation = ConversationManager(claude, "You are a helpful budgeting assistant", token_budget=2000)
+
+    for turn in range(60):
+        conversation.send_message(f"Turn {turn}: how does my spending look compared to last week? " * 4)
+
+    sent = claude.sent_tokens
+    print(f"tokens sent on turns 1/10/30/60: {sent[0]}/{sent[9]}/{sent[29]}/{sent[59]}")
+    print(f"summaries: {claude.summaries}, verbatim messages kept: {len(conversation.get_history())}")
+
+    # growth flattens: the second half of the session never exceeds the budget plus the cached prefix
+    assert max(sent[30:]) <= 2000 + conversation.summary_max_tokens + 50
+    assert len(conversation.get_history()) < 60
+
+    # however far over budget, the last keep_recent messages are always sent verbatim
+    claude = RecordingClaude()
+    sent_counts = []
+    reply = claude.chat_with_history
+    claude.chat_with_history = lambda messages, **kwargs: sent_counts.append(len(messages)) or reply(messages, **kwargs)
+    conversation = ConversationManager(claude, token_budget=50, keep_recent=4)
+    for turn in range(8):
+        conversation.send_message(f"Turn {turn}: where did my money go? " * 20)
+    print(f"messages sent per turn when always over budget: {sent_counts}")
+    assert all(count >= min(4, 2 * turn + 1) for turn, count in enumerate(sent_counts))
+
+    # a failed send leaves the history ending on the last answered turn (compacted or not)
+    def overloaded(**kwargs):
+        raise RuntimeError("overloaded")
+    claude.chat_with_history = overloaded
+    try:
+        conversation.send_message("And last month?")
+        raise AssertionError("should have raised")
+    except RuntimeError:
+        pass
+    history = conversation.get_history()
+    assert history[-1]["role"] == "assistant" and all("last month" not in m["content"] for m in history)
+    assert conversation.history_tokens == sum(estimate_tokens(m["content"]) for m in history)
+    print("✅ conversation manager")
@@ -0,0 +1,276 @@
+"""
+In-memory stand-ins for the services the backend talks to.
+
+ReplayAnthropic answers messages.create from recorded responses (seeded from
+tst/receipt_photos + tst/claude_tst_outputs) and can record new ones through a
+real client. FakeS3 / FakeDynamoDB cover the calls the backend makes. All of
+them count the bytes that would have gone over the wire.
+"""
+import base64
+import hashlib
+import io
+import json
+import os
+import time
+
+from anthropic.types import Message, TextBlock, Usage
+from botocore.exceptions import ClientError
+
+
+def _size(obj) -> int:
+    return len(json.dumps(obj, default=str).encode("utf-8"))
+
+
+class ReplayAnthropic:
+    """Record/replay stand-in for anthropic.Anthropic (messages.create only)."""
+
+    def __init__(self, recordings=None, client=None, latency: float = 0.0):
+        """
+        Args:
+            recordings: {request key: response text}
+            client: Real anthropic client; misses are recorded through it. Without one a miss raises KeyError
+            latency: Seconds to sleep per call, to mimic the API
+        """
+        self.recordings = dict(recordings or {})
+        self.client = client
+        self.latency = latency
+        self.calls = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    @property
+    def messages(self):
+        return self
+
+    @staticmethod
+    def request_key(messages=None, system=None, **kwargs) -> str:
+        """Image requests are keyed by the image alone so prompt edits still replay"""
+        for message in messages or []:
+            content = message.get("content")
+            if isinstance(content, list):
+                for block in content:
+                    if block.get("type") == "image":
+                        return "image:" + hashlib.sha256(block["source"]["data"].encode("utf-8")).hexdigest()
+        canonical = json.dumps({"messages": messages, "system": system}, sort_keys=True, default=str)
+        return "text:" + hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def create(self, **kwargs):
+        self.calls += 1
+        self.bytes_sent += _size(kwargs)
+        key = self.request_key(**kwargs)
+
+        if key not in self.recordings:
+            if self.client is None:
+                raise KeyError(f"No recording for request {key[:24]}")
+            response = self.client.messages.create(**kwargs)
+            self.recordings[key] = response.content[0].text
+
+        if self.latency:
+            time.sleep(self.latency)
+        text = self.recordings[key]
+        self.bytes_received += len(text.encode("utf-8"))
+        return Message(id="msg_replay", type="message", role="assistant", model=kwargs.get("model", "replay"),
+                       content=[TextBlock(type="text", text=text)], stop_reason="end_turn", stop_sequence=None,
+                       usage=Usage(input_tokens=0, output_tokens=len(text) // 4))
+
+    def save(self, path: str):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.recordings, f, indent=2)
+
+    @classmethod
+    def load(cls, path: str, **kwargs) -> "ReplayAnthropic":
+        recordings = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                recordings = json.load(f)
+        return cls(recordings, **kwargs)
+
+    @classmethod
+    def seeded(cls, photo_dir="tst/receipt_photos", output_dir="tst/claude_tst_outputs", **kwargs) -> "ReplayAnthropic":
+        """
+        Recordings for every photo: its saved output, or "None" when there is
+        none (claude_wrapper_tst.py only saves outputs for receipts)
+        """
+        replay = cls(**kwargs)
+        for name in sorted(os.listdir(photo_dir)):
+            with open(os.path.join(photo_dir, name), "rb") as f:
+                data = base64.b64encode(f.read()).decode("utf-8")
+            output = os.path.join(output_dir, name.rsplit(".", 1)[0] + "_output.json")
+            text = "None"
+            if os.path.exists(output):
+                with open(output, "r", encoding="utf-8") as f:
+                    text = json.dumps(json.load(f))
+            key = cls.request_key(messages=[{"role": "user", "content": [{"type": "image", "source": {"data": data}}]}])
+            replay.recordings[key] = text
+        return replay
+
+
+def _etag(body: bytes) -> str:
+    return f'"{hashlib.md5(body).hexdigest()}"'
+
+
+class _Paginator:
+    def __init__(self, s3):
+        self.s3 = s3
+
+    def paginate(self, Bucket, Prefix="", PageSize=1000):
+        keys = sorted(k for b, k in self.s3.objects if b == Bucket and k.startswith(Prefix))
+        for i in range(0, max(len(keys), 1), PageSize):
+            yield {"Contents": [{"Key": k, "Size": len(self.s3.objects[(Bucket, k)])} for k in keys[i:i + PageSize]]}
+
+
+class FakeS3:
+    """boto3 s3 client subset: put_object (with IfMatch / IfNoneMatch), get_object, list_objects_v2 paginator."""
+
+    def __init__(self):
+        self.objects = {}
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    def put_object(self, Bucket, Key, Body, IfMatch=None, IfNoneMatch=None, **kwargs):
+        body = Body.encode("utf-8") if isinstance(Body, str) else bytes(Body)
+        current = self.objects.get((Bucket, Key))
+        if (IfNoneMatch == "*" and current is not None) or \
+                (IfMatch is not None and (current is None or _etag(current) != IfMatch)):
+            raise ClientError({"Error": {"Code": "PreconditionFailed", "Message": "At least one of the pre-conditions you specified did not hold"}}, "PutObject")
+        self.objects[(Bucket, Key)] = body
+        self.bytes_written += len(body)
+        return {}
+
+    def get_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise ClientError({"Error": {"Code": "NoSuchKey", "Message": "The specified key does not exist."}}, "GetObject")
+        body = self.objects[(Bucket, Key)]
+        self.bytes_read += len(body)
+        return {"Body": io.BytesIO(body), "ContentLength": len(body), "ETag": _etag(body)}
+
+    def get_paginator(self, name):
+        assert name == "list_objects_v2"
+        return _Paginator(self)
+
+
+def _check_types(value):
+    # boto3 refuses floats the same way
+    if isinstance(value, float):
+        raise TypeError("Float types are not supported. Use Decimal types instead.")
+    if isinstance(value, dict):
+        for v in value.values():
+            _check_types(v)
+    elif isinstance(value, list):
+        for v in value:
+            _check_types(v)
+
+
+def _evaluate(condition, item) -> bool:
+    """Evaluate a boto3.dynamodb.conditions expression against an item"""
+    expr = condition.get_expression()
+    op, values = expr["operator"], expr["values"]
+    if op == "AND":
+        return all(_evaluate(v, item) for v in values)
+    if op == "OR":
+        return any(_evaluate(v, item) for v in values)
+    if op == "NOT":
+        return not _evaluate(values[0], item)
+
+    name = values[0].name
+    if name not in item:
+        return op == "attribute_not_exists"
+    actual = item[name]
+    args = values[1:]
+    if op == "=":
+        return actual == args[0]
+    if op == "<>":
+        return actual != args[0]
+    if op == "<":
+        return actual < args[0]
+    if op == "<=":
+        return actual <= args[0]
+    if op == ">":
+        return actual > args[0]
+    if op == ">=":
+        return actual >= args[0]
+    if op == "BETWEEN":
+        return args[0] <= actual <= args[1]
+    if op == "begins_with":
+        return str(actual).startswith(args[0])
+    if op == "contains":
+        return args[0] in actual
+    if op == "IN":
+        return actual in args[0]
+    if op == "attribute_exists":
+        return True
+    if op == "attribute_not_exists":
+        return False
+    raise NotImplementedError(op)
+
+
+class FakeTable:
+    """boto3 DynamoDB Table subset: put_item, get_item, query (conditions objects only)."""
+
+    def __init__(self, name="receipts", hash_key="userId", range_key="date"):
+        self.name = name
+        self.hash_key = hash_key
+        self.range_key = range_key
+        self.items = {}
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    def _key(self, item):
+        return item[self.hash_key], item.get(self.range_key) if self.range_key else None
+
+    def put_item(self, Item, **kwargs):
+        _check_types(Item)
+        # DynamoDB refuses items missing a key attribute of the table's schema
+        for key in filter(None, (self.hash_key, self.range_key)):
+            if key not in Item:
+                raise ClientError({"Error": {"Code": "ValidationException",
+                                             "Message": f"Missing the key {key} in the item"}}, "PutItem")
+        self.items[self._key(Item)] = Item
+        self.bytes_written += _size(Item)
+        return {}
+
+    def get_item(self, Key, **kwargs):
+        item = self.items.get(self._key(Key))
+        if item is not None:
+            self.bytes_read += _size(item)
+            return {"Item": item}
+        return {}
+
+    def query(self, KeyConditionExpression, FilterExpression=None, ExclusiveStartKey=None,
+              Limit=None, ScanIndexForward=True, **kwargs):
+        matches = sorted((item for item in self.items.values() if _evaluate(KeyConditionExpression, item)),
+                         key=lambda item: item.get(self.range_key, ""), reverse=not ScanIndexForward)
+        if ExclusiveStartKey is not None:
+            start = ExclusiveStartKey[self.range_key]
+            matches = [i for i in matches if (i[self.range_key] > start if ScanIndexForward else i[self.range_key] < start)]
+
+        # Limit applies to items evaluated, before the filter, like DynamoDB
+        page = matches[:Limit] if Limit else matches
+        result = {"Items": [i for i in page if FilterExpression is None or _evaluate(FilterExpression, i)]}
+        result["Count"] = len(result["Items"])
+        self.bytes_read += sum(_size(i) for i in page)
+        if Limit and len(matches) > Limit:
+            last = page[-1]
+            result["LastEvaluatedKey"] = {self.hash_key: last[self.hash_key], self.range_key: last[self.range_key]}
+        return result
+
+    def __len__(self):
+        return len(self.items)
+
+
+class FakeDynamoDB:
+    """boto3 dynamodb resource subset: Table(name)"""
+
+    def __init__(self, schemas=None):
+        """
+        Args:
+            schemas: {table name: (hash key, range key)}; other tables use the receipts schema (userId, date)
+        """
+        self.tables = {}
+        self.schemas = schemas or {}
+
+    def Table(self, name):
+        if name not in self.tables:
+            hash_key, range_key = self.schemas.get(name, ("userId", "date"))
+            self.tables[name] = FakeTable(name, hash_key=hash_key, range_key=range_key)
+        return self.tables[name]
@@ -0,0 +1,139 @@
+import base64
+import io
+import json
+import os
+import sys
+import time
+
+from PIL import Image
+
+sys.path.insert(0, "src/backend/receipt_lambda")
+os.environ.setdefault("RECEIPTS_TABLE", "receipts")
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ.setdefault("ANTHROPIC_API_KEY", "replay")
+
+from fakes import FakeS3, FakeTable, ReplayAnthropic
+
+import app
+from claude_wrapper import ClaudeWrapper
+from multi_receipt import check_totals, detect_regions, extract_pages, merge_pages, to_amount
+from receipt_prefilter import ReceiptPrefilter
+
+LATENCY = 0.2
+
+
+def encode(image):
+    buf = io.BytesIO()
+    image.convert("RGB").save(buf, format="JPEG", quality=90)
+    return base64.b64encode(buf.getvalue()).decode("utf-8")
+
+
+def image_key(b64):
+    return ReplayAnthropic.request_key(messages=[{"role": "user", "content": [{"type": "image", "source": {"data": b64}}]}])
+
+
+def scene_with(photos, size=(2400, 1600)):
+    """Several receipts laid side by side on a dark table"""
+    scene = Image.new("RGB", size, (45, 35, 30))
+    slot = size[0] // len(photos)
+    for i, photo in enumerate(photos):
+        photo = photo.copy()
+        photo.thumbnail((slot - 200, size[1] - 200))
+        scene.paste(photo, (i * slot + 100, 100))
+    return scene
+
+
+if __name__ == "__main__":
+    with open("tst/claude_tst_outputs/picture_1_output.json", "r", encoding="utf-8") as f:
+        receipt = json.load(f)
+    items = receipt["items"]
+
+    # ---- merging overlapping shots ----
+    top = {"vendor": receipt["vendor"], "date": receipt["date"], "items": items[:3]}
+    bottom = {"vendor": None, "items": items[2:],
+              **{k: receipt[k] for k in ("subtotal", "taxes", "fees", "total")}}
+    merged = merge_pages([top, None, bottom])
+    print(f"merged {len(top['items'])} + {len(bottom['items'])} items -> {len(merged['items'])}")
+    assert merged["items"] == items
+    assert merged["vendor"] == receipt["vendor"] and merged["total"] == receipt["total"]
+    assert check_totals(merged) == [], check_totals(merged)
+
+    broken = dict(merged, total=merged["total"] + 5)
+    print(f"warnings: {check_totals(broken)}")
+    assert len(check_totals(broken)) == 1
+
+    # amounts the model writes as text: parsed when they're money, reported (not raised) when not
+    assert [to_amount(v) for v in ("$3.50", "1,234.50", " 2 ", 4, "N/A", "", None, True, "nan")] == \
+        [3.5, 1234.5, 2.0, 4.0, None, None, None, None, None]
+    as_text = [dict(i, cost=f"${i['cost']:.2f}") for i in items]
+    assert merge_pages([{"items": as_text[:3]}, {"items": items[2:]}])["items"] == as_text[:3] + items[3:]
+    assert merge_pages([{"items": [{"name": "Tip", "cost": "N/A"}]}, {"items": [{"name": "Tip", "cost": "N/A"}]}])["items"] \
+        == [{"name": "Tip", "cost": "N/A"}]
+    assert check_totals(dict(merged, items=as_text, total=f"${merged['total']}")) == []
+    unreadable = check_totals(dict(merged, items=as_text[:-1] + [dict(items[-1], cost="N/A")], taxes="see below", total="N/A"))
+    print(f"unreadable amounts: {unreadable}")
+    assert len(unreadable) == 3 and all("is not an amount" in w for w in unreadable)
+
+    # ---- pages read in parallel ----
+    pages = [encode(Image.new("RGB", (800, 1200), "white")), encode(Image.new("RGB", (800, 1200), (250, 250, 250)))]
+    replay = ReplayAnthropic({image_key(pages[0]): json.dumps(top), image_key(pages[1]): json.dumps(bottom)},
+                             latency=LATENCY)
+    claude = ClaudeWrapper()
+    claude.client = replay
+
+    start = time.perf_counter()
+    result = json.loads(extract_pages(claude, pages))
+    elapsed = time.perf_counter() - start
+    print(f"2 pages in {elapsed:.2f}s (one call takes {LATENCY:.2f}s)")
+    assert result["items"] == items and replay.calls == 2
+    assert elapsed < 1.5 * LATENCY
+
+    # ---- several receipts in one scan ----
+    photos = [Image.open(f"tst/receipt_photos/picture_{n}.jpeg") for n in (1, 2, 4)]
+    scene = encode(scene_with(photos))
+    start = time.perf_counter()
+    regions = detect_regions(scene)
+    print(f"scene of 3 receipts -> {len(regions)} regions in {(time.perf_counter() - start) * 1000:.0f} ms")
+    assert len(regions) == 3
+
+    # the handler passes the pre-filter's thumbnail instead of decoding again
+    thumbnail = ReceiptPrefilter().check(scene).features["thumbnail"]
+    regions = detect_regions(scene, thumbnail)
+    assert len(regions) == 3
+
+    for n in range(1, 6):
+        with open(f"tst/receipt_photos/picture_{n}.jpeg", "rb") as f:
+            b64 = base64.b64encode(f.read()).decode("utf-8")
+        assert detect_regions(b64) == [b64], f"picture_{n} must stay one image"
+        features = ReceiptPrefilter().check(b64).features
+        assert detect_regions(b64, features["thumbnail"]) == [b64], f"picture_{n} must stay one image"
+    print("single photos left whole")
+
+    # ---- handler: one row per receipt in the scan, one merged row for a page list ----
+    replay = ReplayAnthropic({image_key(r): json.dumps(dict(top, date=f"2025-09-1{i}")) for i, r in enumerate(regions)},
+                             latency=LATENCY)
+    replay.recordings.update({image_key(pages[0]): json.dumps(top), image_key(pages[1]): json.dumps(bottom)})
+    claude.client = replay
+    s3, table = FakeS3(), FakeTable()
+    app.s3, app.ddb, app.ClaudeWrapper = s3, table, lambda: claude
+    app.prefilter = app.ReceiptPrefilter()
+
+    s3.put_object(Bucket="b", Key="receipts/uploads/shluck/scan.txt", Body="data:image/jpeg;base64," + scene)
+    s3.put_object(Bucket="b", Key="receipts/uploads/shluck/long.txt",
+                  Body=json.dumps(["data:image/jpeg;base64," + p for p in pages]))
+    app.handler({"Records": [{"s3": {"bucket": {"name": "b"}, "object": {"key": k}}}
+                             for k in ("receipts/uploads/shluck/scan.txt", "receipts/uploads/shluck/long.txt")]}, None)
+
+    rows = sorted(table.items.values(), key=lambda r: r["date"])
+    for row in rows:
+        print(f"{row['date']:14} {row['status']:8} items={len(row.get('items', []))} warnings={row.get('warnings')}")
+    assert [r["date"] for r in rows] == [receipt["date"], "2025-09-10#0", "2025-09-11#1", "2025-09-12#2"]
+    assert len(rows[0]["items"]) == len(items) and "warnings" not in rows[0]
+
+    # text amounts don't fail the store: the category still counts readable costs, the row carries warnings
+    odd = dict(receipt, date="2025-10-01", items=[{"name": "Tea", "cost": "$4.00", "category": "Food"},
+                                                 {"name": "Mug", "cost": "N/A", "category": "Shopping"}], total="N/A")
+    row = app.store_result("receipts/uploads/shluck/odd.txt", json.dumps(odd), table=table)
+    print(f"text amounts: category={row['category']} warnings={row['warnings']}")
+    assert row["category"] == "Food" and len(row["warnings"]) == 2
+    print("✅ multi-page and multi-receipt uploads stored")
@@ -0,0 +1,201 @@
+import base64
+import io
+import json
+import os
+import random
+import sys
+import time
+
+from PIL import Image, ImageDraw, ImageEnhance, ImageFilter
+
+sys.path.insert(0, "src/backend/receipt_lambda")
+os.environ.setdefault("RECEIPTS_TABLE", "receipts")
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ.setdefault("ANTHROPIC_API_KEY", "replay")
+
+from fakes import FakeS3, FakeTable, ReplayAnthropic
+from receipt_prefilter import ReceiptPrefilter
+
+import app
+from claude_wrapper import ClaudeWrapper
+
+
+def encode(image, quality=85):
+    buf = io.BytesIO()
+    image.convert("RGB").save(buf, format="JPEG", quality=quality)
+    return base64.b64encode(buf.getvalue()).decode("utf-8")
+
+
+def labelled_set():
+    """(name, base64, is_receipt) built from tst/receipt_photos plus derived negatives."""
+    rng = random.Random(0)
+    photos = {n: Image.open(f"tst/receipt_photos/picture_{n}.jpeg").convert("RGB") for n in range(1, 5)}
+    samples = []
+
+    for n, photo in photos.items():
+        samples.append((f"picture_{n}", encode(photo), True))
+        samples.append((f"picture_{n}_rotated", encode(photo.rotate(90, expand=True)), True))
+        samples.append((f"picture_{n}_small_q50", encode(photo.reduce(2), quality=50), True))
+        samples.append((f"picture_{n}_dim", encode(ImageEnhance.Brightness(photo).enhance(0.85)), True))
+        samples.append((f"picture_{n}_blurred", encode(photo.filter(ImageFilter.GaussianBlur(25))), False))
+
+    # picture_5 is a food photo, not a receipt (the model answers "None" for it)
+    samples.append(("picture_5", encode(Image.open("tst/receipt_photos/picture_5.jpeg")), False))
+
+    # background-only strip left of the receipt in picture_1, kept inside the image so it has no padding
+    width, height = photos[1].size
+    strip = (0, 0, min(200, width // 6), min(400, height))
+    samples.append(("picture_1_background", encode(photos[1].crop(strip)), False))
+
+    samples.append(("blank_white", encode(Image.new("RGB", (900, 1200), "white")), False))
+    samples.append(("blank_grey", encode(Image.new("RGB", (900, 1200), (128, 128, 128))), False))
+    samples.append(("dark_frame", encode(Image.effect_noise((900, 1200), 4).point(lambda v: v // 8)), False))
+    samples.append(("noise", encode(Image.effect_noise((900, 1200), 120)), False))
+    samples.append(("gradient", encode(Image.linear_gradient("L").resize((900, 1200))), False))
+    samples.append(("banner", encode(Image.new("RGB", (3000, 150), "white").filter(ImageFilter.DETAIL)), False))
+
+    scene = Image.new("RGB", (1200, 900), (40, 120, 200))
+    draw = ImageDraw.Draw(scene)
+    for _ in range(40):
+        x, y = rng.randrange(1100), rng.randrange(800)
+        draw.ellipse([x, y, x + rng.randrange(1, 300), y + rng.randrange(1, 300)],
+                     fill=(rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+    samples.append(("colour_scene", encode(scene), False))
+
+    return samples
+
+
+def store_receipt(seed):
+    """A receipt from the same store each time: same header and layout, different items"""
+    rng = random.Random(seed)
+    photo = Image.new("RGB", (600, 1400), (70, 60, 50))
+    paper = Image.new("RGB", (420, 1300), (245, 243, 238))
+    draw = ImageDraw.Draw(paper)
+    draw.text((120, 30), "TRADER JOE'S", fill="black")
+    draw.text((110, 50), "6343 PENN AVE PITTSBURGH", fill="black")
+    y = 110
+    for _ in range(rng.randrange(6, 30)):
+        draw.text((30, y), f"ITEM {rng.randrange(1000)} " + "X" * rng.randrange(3, 15), fill="black")
+        draw.text((330, y), f"{rng.randrange(100, 2000) / 100:.2f}", fill="black")
+        y += 22
+    draw.text((30, y + 20), "TOTAL", fill="black")
+    photo.paste(paper, (90, 50))
+    return photo
+
+
+class FlakyReplay(ReplayAnthropic):
+    """Fails the first `failures` calls the way a rate-limited API would"""
+
+    def __init__(self, *args, failures=1, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.failures = failures
+
+    def create(self, **kwargs):
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError("429 rate limited")
+        return super().create(**kwargs)
+
+
+def upload(s3, key, b64):
+    s3.put_object(Bucket="b", Key=key, Body="data:image/jpeg;base64," + b64)
+    return {"Records": [{"s3": {"bucket": {"name": "b"}, "object": {"key": key}}}]}
+
+
+if __name__ == "__main__":
+    prefilter = ReceiptPrefilter()
+    tp = fp = tn = fn = 0
+    elapsed = []
+
+    for name, b64, is_receipt in labelled_set():
+        start = time.perf_counter()
+        verdict = prefilter.check(b64)
+        elapsed.append((time.perf_counter() - start) * 1000)
+
+        if verdict and is_receipt:
+            tp += 1
+        elif verdict:
+            fp += 1
+        elif is_receipt:
+            fn += 1
+        else:
+            tn += 1
+        print(f"{name:28} receipt={is_receipt!s:5} accepted={verdict.accepted!s:5} {verdict.reason}")
+
+    # "receipt" is the positive class: recall is the share of real receipts that still reach Claude
+    precision = tp / max(tp + fp, 1)
+    recall = tp / max(tp + fn, 1)
+    rejection_rate = tn / max(tn + fp, 1)
+    print(f"\nprecision={precision:.2f} recall={recall:.2f} non-receipts rejected={rejection_rate:.2f}")
+    print(f"mean {sum(elapsed) / len(elapsed):.1f} ms, max {max(elapsed):.1f} ms per image")
+
+    # a recompressed re-upload by the same user is caught as a duplicate
+    dedupe = ReceiptPrefilter()
+    photo = Image.open("tst/receipt_photos/picture_2.jpeg")
+    first = dedupe.check(encode(photo), user="shluck", key="a.txt")
+    assert first and dedupe.check(encode(photo), user="shluck", key="a.txt"), "nothing is remembered by check"
+    dedupe.remember("shluck", first.features, "a.txt")
+    assert dedupe.check(encode(photo), user="shluck", key="a.txt"), "an upload is not a duplicate of itself"
+    repeat = dedupe.check(encode(photo.reduce(2), quality=60), user="shluck")
+    other = dedupe.check(encode(Image.open("tst/receipt_photos/picture_3.jpeg")), user="shluck")
+    print(f"re-upload: {repeat}, different receipt: {other}")
+    assert repeat.reason == "duplicate" and other
+
+    # dHash can't tell receipts from the same store apart, so near matches only count shortly after an upload
+    same_store = [encode(store_receipt(seed)) for seed in range(12)]
+    for gap in (60, 3600):
+        dedupe = ReceiptPrefilter()
+        false_duplicates = 0
+        for i, b64 in enumerate(same_store):
+            verdict = dedupe.check(b64, user="shluck", key=f"{i}.txt", now=i * gap)
+            if verdict.reason == "duplicate":
+                false_duplicates += 1
+            else:
+                assert verdict, verdict
+                dedupe.remember("shluck", verdict.features, f"{i}.txt", now=i * gap)
+        false_duplicate_rate = false_duplicates / (len(same_store) - 1)
+        print(f"same-store receipts {gap}s apart: false-duplicate rate={false_duplicate_rate:.2f}")
+    assert false_duplicate_rate == 0
+    assert dedupe.check(same_store[0], user="shluck", now=len(same_store) * 3600).reason == "duplicate", \
+        "the same file again is a duplicate at any time"
+
+    assert recall == 1.0, "real receipts must never be rejected"
+    assert rejection_rate >= 0.9
+
+    # a vision call that fails is retried by Lambda on the same warm container; the retry must not be a duplicate
+    with open("tst/receipt_photos/picture_2.jpeg", "rb") as f:
+        picture_2 = base64.b64encode(f.read()).decode("utf-8")
+    with open("tst/claude_tst_outputs/picture_2_output.json", "r", encoding="utf-8") as f:
+        recorded = json.load(f)
+    claude = ClaudeWrapper()
+    claude.client = FlakyReplay(ReplayAnthropic.seeded().recordings)
+    s3, table = FakeS3(), FakeTable()
+    app.s3, app.ddb, app.ClaudeWrapper = s3, table, lambda: claude
+    app.prefilter = ReceiptPrefilter()
+
+    event = upload(s3, "receipts/uploads/shluck/lunch.txt", picture_2)
+    try:
+        app.handler(event, None)
+        raise AssertionError("first attempt should fail")
+    except RuntimeError:
+        pass
+    app.handler(event, None)
+    statuses = [row["status"] for row in table.items.values()]
+    print(f"after a failed attempt and its retry: {statuses}")
+    assert statuses == ["parsed"]
+
+    # a same-day re-upload and a second reject each get their own row next to the receipt
+    today = time.strftime("%Y-%m-%d", time.gmtime())
+    table.items.clear()
+    app.prefilter = ReceiptPrefilter()
+    claude.client = ReplayAnthropic({**ReplayAnthropic.seeded().recordings,
+                                     ReplayAnthropic.request_key(messages=[{"role": "user", "content": [
+                                         {"type": "image", "source": {"data": picture_2}}]}]):
+                                         json.dumps(dict(recorded, date=today))})
+    app.handler(upload(s3, "receipts/uploads/shluck/lunch.txt", picture_2), None)
+    for name in ("again.txt", "again_2.txt"):
+        app.handler(upload(s3, f"receipts/uploads/shluck/{name}", picture_2), None)
+    rows = sorted(table.items.values(), key=lambda r: r["date"])
+    print(f"same-day rows: {[(r['date'], r['status']) for r in rows]}")
+    assert [r["status"] for r in rows] == ["parsed", "duplicate", "duplicate"]
+    assert rows[0]["date"] == today and rows[0]["s3Key"] == "receipts/uploads/shluck/lunch.txt"
@@ -0,0 +1,125 @@
+import gzip
+import json
+import random
+import sys
+from datetime import date, timedelta
+from decimal import Decimal
+
+sys.path.insert(0, "src/backend")
+sys.path.insert(0, "src/backend/receipt_lambda")
+
+from fakes import FakeDynamoDB
+
+import main
+from multi_receipt import vendor_key
+
+CATEGORIES = ["Food & Dining", "Transportation", "Entertainment", "Utilities", "Shopping"]
+VENDORS = ["Trader Joe's", "Shell", "AMC Theatres", "Duquesne Light", "Target", "Giant Eagle"]
+
+
+def receipt_rows(user_id, days=3 * 365, seed=0):
+    """Years of receipt rows the way the Lambda writes them, including scans split into parts and rejects"""
+    rng = random.Random(seed)
+    rows, start = [], date(2023, 1, 1)
+    for d in range(days):
+        day = (start + timedelta(days=d)).isoformat()
+        kind = rng.random()
+        if kind < 0.1:
+            rows.append({"userId": user_id, "date": day, "status": "unrecognized", "s3Key": "k"})
+            continue
+        parts = [f"#{n}" for n in range(2)] if kind > 0.95 else [""]
+        for suffix in parts:
+            vendor = rng.choice(VENDORS)
+            rows.append({"userId": user_id, "date": day + suffix, "status": "parsed",
+                         "vendor": vendor, "vendorKey": vendor_key(vendor), "category": rng.choice(CATEGORIES),
+                         "items": [{"name": "item", "cost": Decimal("1.00")}] * 8,
+                         "total": Decimal(str(rng.randrange(100, 20000) / 100))})
+    return rows
+
+
+def get(client, headers=None, **params):
+    return client.get("/api/transactions", query_string=params, headers=headers or {})
+
+
+def all_pages(client, **params):
+    seen, cursor = [], None
+    while True:
+        body = get(client, **params, **({"cursor": cursor} if cursor else {})).get_json()
+        seen.extend(body["transactions"])
+        cursor = body["next_cursor"]
+        if not cursor:
+            return seen
+
+
+if __name__ == "__main__":
+    dynamodb = FakeDynamoDB()
+    main.dynamodb = dynamodb
+    table = dynamodb.Table(main.TABLE_NAME)
+    rows = receipt_rows("shluck") + receipt_rows("someone_else", days=30, seed=1)
+    for row in rows:
+        table.put_item(Item=row)
+    parsed = sorted((r for r in rows if r["userId"] == "shluck" and r["status"] == "parsed"),
+                    key=lambda r: r["date"], reverse=True)
+    client = main.app.test_client()
+
+    # ---- first screen: newest page in one small response ----
+    first = get(client, user_id="shluck")
+    body = first.get_json()
+    print(f"first screen: {body['count']} transactions, {len(first.get_data())} bytes of {len(parsed)} receipts")
+    assert first.status_code == 200 and body["count"] == main.PAGE_SIZE
+    assert [t["id"] for t in body["transactions"]] == [r["date"] for r in parsed[:main.PAGE_SIZE]]
+    assert set(body["transactions"][0]) == {"id", "name", "amount", "date", "category"}
+    assert len(first.get_data()) < 4096
+
+    # ---- cursor walks every parsed row exactly once, in both orders ----
+    walked = all_pages(client, user_id="shluck", limit=100)
+    assert [t["id"] for t in walked] == [r["date"] for r in parsed]
+    assert [t["id"] for t in all_pages(client, user_id="shluck", order="asc", limit=77)] == [r["date"] for r in reversed(parsed)]
+    print(f"walked {len(walked)} transactions by cursor")
+
+    # ---- filters ----
+    in_range = all_pages(client, user_id="shluck", **{"from": "2024-02-01", "to": "2024-02-29"})
+    expected = [r["date"] for r in parsed if "2024-02-01" <= r["date"][:10] <= "2024-02-29"]
+    assert [t["id"] for t in in_range] == expected and in_range
+
+    split_day = next(r["date"][:10] for r in parsed if "#" in r["date"])
+    same_day = get(client, user_id="shluck", **{"from": split_day, "to": split_day}).get_json()["transactions"]
+    assert [t["id"] for t in same_day] == [f"{split_day}#1", f"{split_day}#0"], same_day
+
+    shell = all_pages(client, user_id="shluck", vendor="Shell", category="Transportation", limit=10)
+    assert [t["id"] for t in shell] == [r["date"] for r in parsed
+                                        if r["vendor"] == "Shell" and r["category"] == "Transportation"]
+    assert all(t["date"] == t["id"][:10] for t in shell)
+    trader_joes = all_pages(client, user_id="shluck", vendor="  TRADER joe", limit=25)
+    assert [t["id"] for t in trader_joes] == [r["date"] for r in parsed if r["vendor"] == "Trader Joe's"]
+    print(f"filters: {len(in_range)} in Feb 2024, {len(shell)} Shell/Transportation")
+
+    # ---- unchanged page revalidates to a 304 with no body ----
+    etag = first.headers["ETag"]
+    again = get(client, headers={"If-None-Match": etag}, user_id="shluck")
+    assert again.status_code == 304 and again.get_data() == b""
+    table.put_item(Item={**parsed[0], "date": "2026-01-01", "total": Decimal("1.50")})
+    changed = get(client, headers={"If-None-Match": etag}, user_id="shluck")
+    assert changed.status_code == 200 and changed.get_json()["transactions"][0]["id"] == "2026-01-01"
+    print(f"ETag {etag}: 304 while unchanged, 200 after a new receipt")
+
+    # ---- gzip when accepted ----
+    big = get(client, headers={"Accept-Encoding": "gzip"}, user_id="shluck", limit=100)
+    plain = get(client, user_id="shluck", limit=100)
+    assert big.headers["Content-Encoding"] == "gzip"
+    assert json.loads(gzip.decompress(big.get_data())) == plain.get_json()
+    print(f"gzip: {len(plain.get_data())} -> {len(big.get_data())} bytes")
+
+    # ---- bad requests ----
+    other_cursor = get(client, user_id="someone_else", limit=5).get_json()["next_cursor"]
+    assert get(client).status_code == 400
+    assert get(client, user_id="shluck", cursor="not-a-cursor").status_code == 400
+    assert get(client, user_id="shluck", cursor=other_cursor).status_code == 400
+    assert get(client, user_id="shluck", **{"from": "last week"}).status_code == 400
+    assert get(client, user_id="shluck", limit="ten").status_code == 400
+
+    # totals the model wrote as text still list, falling back to the subtotal when unreadable
+    table.put_item(Item={**parsed[0], "date": "2026-02-01", "total": "N/A", "subtotal": "$12.00"})
+    odd = get(client, user_id="shluck", **{"from": "2026-02-01"}).get_json()["transactions"]
+    assert [t["amount"] for t in odd] == [12.0]
+    print("✅ transactions endpoint")